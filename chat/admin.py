@@ -5,6 +5,7 @@ from .models import Chat, ChatParticipant, Message, MessageStatus
 class ChatParticipantInline(admin.TabularInline):
     model = ChatParticipant
     extra = 0
+    raw_id_fields = ("last_delivered_message", "last_read_message")
 
 
 class MessageStatusInline(admin.TabularInline):
@@ -38,3 +39,4 @@ class MessageStatusAdmin(admin.ModelAdmin):
 class ChatParticipantAdmin(admin.ModelAdmin):
     list_display = ("id", "chat", "user", "joined_at")
     list_filter = ("joined_at",)
+    raw_id_fields = ("last_delivered_message", "last_read_message")
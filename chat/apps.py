@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chat"
+
+    def ready(self):
+        from . import signals, tasks  # noqa: F401
+        from .ids import check_message_id_nodes
+        from .services import uses_write_behind
+
+        # Fail at startup rather than on the first duplicate id
+        if uses_write_behind():
+            check_message_id_nodes()
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+# Custom epoch (2024-01-01 UTC) keeping ids small
+EPOCH_MS = 1704067200000
+NODE_BITS = 5
+COUNTER_BITS = 8
+
+
+class MessageIdGenerator:
+    """
+    Time-ordered 53-bit ids generated without a database round trip.
+
+    An id packs the milliseconds since ``EPOCH_MS`` with a node number and a
+    per-millisecond counter, so ids from one node strictly increase and ids
+    from different nodes sort by creation time. 53 bits keep them exact as
+    JavaScript numbers.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.last_ms = 0
+        self.counter = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = max(int(time.time() * 1000) - EPOCH_MS, self.last_ms)
+            if now == self.last_ms:
+                self.counter += 1
+                if self.counter >> COUNTER_BITS:
+                    # Counter exhausted for this millisecond, borrow the next
+                    now += 1
+                    self.counter = 0
+            else:
+                self.counter = 0
+            self.last_ms = now
+            return (
+                (now << (NODE_BITS + COUNTER_BITS))
+                | (self.node << COUNTER_BITS)
+                | self.counter
+            )
+
+
+class NodeLease:
+    """
+    Node number leased from the shared cache for this process.
+
+    Every process claims the first free node with an atomic ``cache.add``
+    and renews the lease while it generates ids. A process that finds its
+    lease was taken over, e.g. after sitting idle past ``ttl``, or that was
+    forked from the claiming process, claims a new node.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.node = None
+        self.pid = None
+        self.token = None
+        self.renew_at = 0
+        self._lock = threading.Lock()
+
+    def _key(self, node):
+        return f"chat:message-id-node:{node}"
+
+    def current(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.node is None or self.pid != os.getpid():
+                self._claim()
+            elif now >= self.renew_at:
+                if cache.get(self._key(self.node)) == self.token:
+                    cache.touch(self._key(self.node), self.ttl)
+                    self.renew_at = now + self.ttl / 2
+                else:
+                    self._claim()
+            return self.node
+
+    def _claim(self):
+        token = uuid.uuid4().hex
+        for node in range(1 << NODE_BITS):
+            if cache.add(self._key(node), token, self.ttl):
+                self.node, self.pid, self.token = node, os.getpid(), token
+                self.renew_at = time.monotonic() + self.ttl / 2
+                return
+        raise RuntimeError("No free message id node: too many processes")
+
+
+def check_message_id_nodes():
+    """
+    Refuse write-behind when processes cannot coordinate their nodes.
+
+    Leases live in the default cache, which only reaches other processes
+    when it is shared (Redis).
+    """
+    backend = settings.CACHES["default"]["BACKEND"]
+    shared = not backend.endswith(("LocMemCache", "DummyCache"))
+    if not shared and getattr(settings, "WEB_CONCURRENCY", 1) > 1:
+        raise ImproperlyConfigured(
+            "CHAT_WRITE_BEHIND with several workers needs a shared cache "
+            "(REDIS_URL) to give each process its own message id node"
+        )
+
+
+_lease = NodeLease()
+_generator = None
+
+
+def next_message_id():
+    """Next application generated message id for this process"""
+    global _generator
+    node = _lease.current()
+    if _generator is None or _generator.node != node:
+        _generator = MessageIdGenerator(node)
+    return _generator.next_id()
@@ -0,0 +1,76 @@
+import time
+import uuid
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from chat.models import Chat, ChatParticipant
+from chat.services import create_message
+from core.benchmarking import summarize, write_report
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Measure message creation latency against chat group size"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="2,10,50,200,500",
+            help="Comma separated list of group sizes",
+        )
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+        parser.add_argument("--output", help="Also write the JSON report here")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",") if size]
+        rows = []
+
+        for size in sizes:
+            rows.append(self.run_size(size, options["iterations"]))
+
+        write_report(
+            self,
+            {"benchmark": "create_message", "rows": rows},
+            options["json"],
+            options["output"],
+        )
+
+    def run_size(self, size, iterations):
+        """Create ``iterations`` messages in a fresh chat of ``size`` members"""
+        prefix = f"bench_{uuid.uuid4().hex[:8]}"
+        users = User.objects.bulk_create(
+            [
+                User(username=f"{prefix}_{i}", email=f"{prefix}_{i}@bench.local")
+                for i in range(size)
+            ]
+        )
+        chat = Chat.objects.create(name=prefix)
+        ChatParticipant.objects.bulk_create(
+            [ChatParticipant(chat=chat, user=user) for user in users]
+        )
+        sender = users[0]
+
+        try:
+            # Query count for a single creation
+            with CaptureQueriesContext(connection) as queries:
+                create_message(chat.id, sender, "warmup")
+
+            samples = []
+            for i in range(iterations):
+                started = time.perf_counter()
+                create_message(chat.id, sender, f"message {i}")
+                samples.append((time.perf_counter() - started) * 1000)
+        finally:
+            chat.delete()
+            User.objects.filter(username__startswith=f"{prefix}_").delete()
+
+        summary = summarize(samples)
+        return {
+            "group_size": size,
+            "iterations": summary.pop("count"),
+            "queries": len(queries.captured_queries),
+            **{f"{key}_ms": value for key, value in summary.items()},
+        }
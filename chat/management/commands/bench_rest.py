@@ -0,0 +1,321 @@
+import json
+import random
+import time
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from chat.models import Chat, ChatParticipant, Message, MessageStatus
+from chat.receipts import uses_watermarks
+from core.benchmarking import summarize, write_report
+from reactions.models import Reaction
+
+User = get_user_model()
+
+PREFIX = "benchrest"
+
+# Most queries a single request may issue: a fixed part plus a part per
+# item in the response. Raise a budget only together with the change that
+# needs it.
+QUERY_BUDGETS = {
+    # Chats, participants and last messages, see load_chat_previews
+    "chat_list": (6, 0),
+    "chat_messages": (10, 0),
+    "message_list": (4, 0),
+    "message_create": (14, 0),
+    "update_all_status": (6, 0),
+    "reaction_list": (2, 0),
+    "reaction_create": (4, 0),
+}
+
+# Plan nodes that read table rows, counted by --explain
+SCAN_NODES = {
+    "Seq Scan",
+    "Index Scan",
+    "Index Only Scan",
+    "Bitmap Heap Scan",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the hot REST endpoints against a seeded data set and fail when "
+        "one issues more queries than its budget"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chats", type=int, default=1000)
+        parser.add_argument(
+            "--user-chats",
+            type=int,
+            default=80,
+            help="Chats the benchmark user takes part in",
+        )
+        parser.add_argument("--members", type=int, default=5, help="Users per chat")
+        parser.add_argument(
+            "--messages", type=int, default=50, help="Messages per chat"
+        )
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Count rows scanned with EXPLAIN ANALYZE (PostgreSQL only)",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the seeded data and reuse it on the next run",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+        parser.add_argument("--output", help="Also write the JSON report here")
+
+    def handle(self, *args, **options):
+        if options["members"] < 2 or options["user_chats"] > options["chats"]:
+            raise CommandError("Need two members per chat and enough chats")
+        if options["explain"] and connection.vendor != "postgresql":
+            raise CommandError("--explain needs PostgreSQL")
+
+        user = User.objects.filter(username=f"{PREFIX}_main").first()
+        seeded = user is None
+        started = time.perf_counter()
+        if seeded:
+            user = self.seed(options)
+        seed_seconds = round(time.perf_counter() - started, 1)
+
+        data = {
+            "chats": Chat.objects.filter(name__startswith=f"{PREFIX}_").count(),
+            "user_chats": ChatParticipant.objects.filter(user=user).count(),
+            "messages": Message.objects.filter(
+                chat__name__startswith=f"{PREFIX}_"
+            ).count(),
+        }
+
+        try:
+            rows = self.run_endpoints(user, options)
+        finally:
+            if not options["keep"]:
+                self.clean()
+
+        over = [row["endpoint"] for row in rows if not row["within_budget"]]
+        write_report(
+            self,
+            {
+                "benchmark": "rest",
+                "database": connection.vendor,
+                "seeded": seeded,
+                "seed_seconds": seed_seconds,
+                "data": data,
+                "rows": rows,
+                "over_budget": over,
+            },
+            options["json"],
+            options["output"],
+        )
+        if over:
+            raise CommandError(f"Over query budget: {', '.join(over)}")
+
+    def run_endpoints(self, user, options):
+        client = APIClient(SERVER_NAME="localhost")
+        client.force_authenticate(user)
+        chat = (
+            Chat.objects.filter(participants__user=user, name__startswith=PREFIX)
+            .order_by("id")
+            .first()
+        )
+        message = Message.objects.filter(chat=chat).order_by("-seq").first()
+        reaction_types = [choice for choice, _ in Reaction.REACTION_TYPES]
+
+        endpoints = [
+            ("chat_list", lambda i: client.get("/api/chats/")),
+            (
+                "chat_messages",
+                lambda i: client.get(f"/api/chats/{chat.id}/messages/?page_size=50"),
+            ),
+            ("message_list", lambda i: client.get(f"/api/messages/?chat_id={chat.id}")),
+            (
+                "message_create",
+                lambda i: client.post(
+                    "/api/messages/",
+                    {"chat": chat.id, "content": f"bench {i}"},
+                    format="json",
+                ),
+            ),
+            (
+                "update_all_status",
+                lambda i: client.put(
+                    f"/api/messages/update_all_status/?chat_id={chat.id}"
+                ),
+            ),
+            (
+                "reaction_list",
+                lambda i: client.get(f"/api/reactions/?message_id={message.id}"),
+            ),
+            (
+                "reaction_create",
+                lambda i: client.post(
+                    "/api/reactions/",
+                    {
+                        "message": message.id,
+                        "type": reaction_types[i % len(reaction_types)],
+                    },
+                    format="json",
+                ),
+            ),
+        ]
+
+        rows = []
+        for name, request in endpoints:
+            samples = []
+            queries = 0
+            budget = 0
+            captured = []
+            for i in range(options["iterations"]):
+                with CaptureQueriesContext(connection) as context:
+                    started = time.perf_counter()
+                    response = request(i)
+                    samples.append((time.perf_counter() - started) * 1000)
+                if response.status_code >= 400:
+                    raise CommandError(
+                        f"{name} returned {response.status_code}: "
+                        f"{response.content[:200]!r}"
+                    )
+                queries = max(queries, len(context.captured_queries))
+                captured = context.captured_queries
+                budget = max(budget, self.budget(name, response))
+
+            summary = summarize(samples)
+            summary.pop("count")
+            rows.append(
+                {
+                    "endpoint": name,
+                    **{f"{key}_ms": value for key, value in summary.items()},
+                    "queries": queries,
+                    "budget": budget,
+                    "within_budget": queries <= budget,
+                    "rows_scanned": (
+                        self.rows_scanned(captured) if options["explain"] else None
+                    ),
+                }
+            )
+        return rows
+
+    def budget(self, name, response):
+        fixed, per_item = QUERY_BUDGETS[name]
+        items = len(response.data) if isinstance(response.data, list) else 0
+        return fixed + per_item * items
+
+    def rows_scanned(self, queries):
+        """Rows read by the SELECTs of one request, from their query plans"""
+        total = 0
+        with connection.cursor() as cursor:
+            for query in queries:
+                if not query["sql"].lstrip().upper().startswith("SELECT"):
+                    continue
+                cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query["sql"])
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                total += self.plan_rows(plan[0]["Plan"])
+        return total
+
+    def plan_rows(self, node):
+        rows = 0
+        if node["Node Type"] in SCAN_NODES:
+            rows += (
+                node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)
+            ) * node.get("Actual Loops", 1)
+        for child in node.get("Plans", ()):
+            rows += self.plan_rows(child)
+        return rows
+
+    def seed(self, options):
+        """Chats with ``members`` users each, ``user_chats`` of them shared
+        with the benchmark user, and ``messages`` messages per chat"""
+        rng = random.Random(0)
+        now = timezone.now()
+        user_count = max(options["members"] * 4, 50)
+
+        with transaction.atomic():
+            main = User.objects.create(
+                username=f"{PREFIX}_main", email=f"{PREFIX}_main@bench.local"
+            )
+            others = User.objects.bulk_create(
+                [
+                    User(username=f"{PREFIX}_{i}", email=f"{PREFIX}_{i}@bench.local")
+                    for i in range(user_count)
+                ],
+                batch_size=1000,
+            )
+            chats = Chat.objects.bulk_create(
+                [
+                    Chat(
+                        name=f"{PREFIX}_{i}",
+                        created_at=now - timedelta(days=30),
+                        last_activity_at=now - timedelta(days=30),
+                        last_message_seq=options["messages"],
+                    )
+                    for i in range(options["chats"])
+                ],
+                batch_size=1000,
+            )
+
+            members = {}
+            for i, chat in enumerate(chats):
+                picked = rng.sample(others, options["members"])
+                if i < options["user_chats"]:
+                    picked[0] = main
+                members[chat.id] = picked
+            ChatParticipant.objects.bulk_create(
+                [
+                    ChatParticipant(chat_id=chat_id, user=user)
+                    for chat_id, users in members.items()
+                    for user in users
+                ],
+                batch_size=5000,
+            )
+
+        # One transaction per chat keeps memory flat for large data sets
+        for chat in chats:
+            users = members[chat.id]
+            with transaction.atomic():
+                messages = Message.objects.bulk_create(
+                    [
+                        Message(
+                            chat=chat,
+                            sender=users[seq % len(users)],
+                            content=f"seed message {seq}",
+                            status="read",
+                            sent_at=now - timedelta(minutes=options["messages"] - seq),
+                            seq=seq,
+                        )
+                        for seq in range(1, options["messages"] + 1)
+                    ]
+                )
+                Chat.record_messages(chat.id, messages)
+                if not uses_watermarks():
+                    MessageStatus.objects.bulk_create(
+                        [
+                            MessageStatus(
+                                message=message,
+                                receiver=receiver,
+                                # The newest messages are still unread
+                                status=(
+                                    "sent"
+                                    if message.seq > options["messages"] - 5
+                                    else "read"
+                                ),
+                            )
+                            for message in messages
+                            for receiver in users
+                            if receiver.id != message.sender_id
+                        ],
+                        batch_size=5000,
+                    )
+        return main
+
+    def clean(self):
+        Chat.objects.filter(name__startswith=f"{PREFIX}_").delete()
+        User.objects.filter(username__startswith=f"{PREFIX}_").delete()
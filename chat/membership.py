@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.cache import cache
+from core.cache import TTLCache
+from .models import ChatParticipant
+
+# Per-process copy of recently used member sets, kept short lived because
+# other processes only invalidate the shared cache
+local_members = TTLCache(
+    maxsize=getattr(settings, "MEMBERSHIP_LOCAL_SIZE", 10000),
+    ttl=getattr(settings, "MEMBERSHIP_LOCAL_TTL", 5),
+)
+
+
+def _shared_key(chat_id):
+    return f"chat:members:{chat_id}"
+
+
+def cached_members(chat_id):
+    """Member ids of a chat from the process cache only, or ``None``"""
+    return local_members.get(int(chat_id))
+
+
+def chat_members(chat_id, refresh=False):
+    """
+    Frozen set with the user ids participating in a chat.
+
+    Looks in the process cache, then the shared cache, then the database.
+    ``refresh`` skips the process cache.
+    """
+    chat_id = int(chat_id)
+    if not refresh:
+        members = local_members.get(chat_id)
+        if members is not None:
+            return members
+
+    try:
+        shared = cache.get(_shared_key(chat_id))
+    except Exception:
+        shared = None
+
+    if shared is None:
+        shared = list(
+            ChatParticipant.objects.filter(chat_id=chat_id).values_list(
+                "user_id", flat=True
+            )
+        )
+        try:
+            cache.set(
+                _shared_key(chat_id),
+                shared,
+                getattr(settings, "MEMBERSHIP_CACHE_TTL", 300),
+            )
+        except Exception:
+            pass
+
+    members = frozenset(shared)
+    local_members.set(chat_id, members)
+    return members
+
+
+def is_member(chat_id, user_id):
+    """Whether a user participates in a chat"""
+    if user_id in chat_members(chat_id):
+        return True
+    # A denial may come from a stale process cache, so confirm it once
+    return user_id in chat_members(chat_id, refresh=True)
+
+
+def invalidate_members(chat_id):
+    """Forget the cached members of a chat in this process and the shared cache"""
+    chat_id = int(chat_id)
+    local_members.invalidate(chat_id)
+    try:
+        cache.delete(_shared_key(chat_id))
+    except Exception:
+        pass
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+def assign_sequences(apps, schema_editor):
+    """Number existing messages per chat in the order they were sent"""
+    Chat = apps.get_model("chat", "Chat")
+    Message = apps.get_model("chat", "Message")
+
+    for chat in Chat.objects.all().iterator():
+        messages = list(
+            Message.objects.filter(chat=chat).order_by("sent_at", "id").only("id")
+        )
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        Message.objects.bulk_update(messages, ["seq"], batch_size=1000)
+        Chat.objects.filter(pk=chat.pk).update(last_message_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0002_chatparticipant_receipt_watermarks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="last_message_seq",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="seq",
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(assign_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0003_message_seq"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="seq",
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name="message",
+            constraint=models.UniqueConstraint(
+                fields=("chat", "seq"), name="chat_message_seq_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,64 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_last_activity(apps, schema_editor):
+    """Point existing chats at their newest message and count their messages"""
+    Chat = apps.get_model("chat", "Chat")
+    Message = apps.get_model("chat", "Message")
+
+    newest = Message.objects.filter(chat=OuterRef("pk")).order_by("-seq")
+    counts = (
+        Message.objects.filter(chat=OuterRef("pk"))
+        .values("chat")
+        .annotate(total=Count("id"))
+        .values("total")
+    )
+    Chat.objects.update(
+        last_message=Subquery(newest.values("id")[:1]),
+        last_activity_at=Coalesce(
+            Subquery(newest.values("sent_at")[:1]), F("created_at")
+        ),
+        message_count=Coalesce(Subquery(counts), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0004_message_seq_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="last_activity_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="last_message",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="chat.message",
+            ),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="chat",
+            index=models.Index(
+                fields=["-last_activity_at", "-id"], name="chat_last_activity_idx"
+            ),
+        ),
+    ]
@@ -1,5 +1,9 @@
 from django.db import models
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.lookups import GreaterThan
 from django.utils import timezone
 
 
@@ -7,10 +11,100 @@ class Chat(models.Model):
     name = models.CharField(max_length=100)
     created_at = models.DateTimeField(default=timezone.now)
     active = models.BooleanField(default=True)
+    # Sequence number handed to the latest message of the chat
+    last_message_seq = models.PositiveBigIntegerField(default=0)
+    # Inbox preview and ordering, kept current by record_messages
+    last_message = models.ForeignKey(
+        "Message",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["-last_activity_at", "-id"], name="chat_last_activity_idx"
+            )
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def allocate_message_seq(cls, chat_id):
+        """
+        Reserve the next message sequence number of a chat.
+
+        For messages stored later (write-behind). Must run inside a
+        transaction: the row lock taken by the update is held until it
+        commits, which keeps numbers consecutive.
+        """
+        cls.objects.filter(pk=chat_id).update(
+            last_message_seq=F("last_message_seq") + 1
+        )
+        return cls.objects.values_list("last_message_seq", flat=True).get(pk=chat_id)
+
+    @classmethod
+    def lock_message_seq(cls, chat_id):
+        """
+        Lock a chat row and return the sequence number of its latest message.
+
+        Must run inside a transaction. The caller stores the next message and
+        hands it to ``record_messages``, which advances the counter in the
+        same update as the rest of the chat's message fields.
+        """
+        return (
+            cls.objects.select_for_update()
+            .values_list("last_message_seq", flat=True)
+            .get(pk=chat_id)
+        )
+
+    @classmethod
+    def record_messages(cls, chat_id, messages):
+        """
+        Count newly stored messages of a chat and point it at the newest.
+
+        Runs as a single update, in the transaction storing the messages.
+        Messages are compared by ``seq``, so batches stored out of order
+        leave the newest message in place whatever their ``sent_at``.
+        """
+        newest = max(messages, key=lambda message: message.seq)
+        current = (
+            Message.objects.filter(pk=OuterRef("last_message")).order_by().values("seq")
+        )
+        is_newest = GreaterThan(Value(newest.seq), Coalesce(Subquery(current), 0))
+        cls.objects.filter(pk=chat_id).update(
+            last_message_seq=Greatest("last_message_seq", Value(newest.seq)),
+            message_count=F("message_count") + len(messages),
+            last_message=Case(
+                When(is_newest, then=Value(newest.pk)),
+                default=F("last_message"),
+                output_field=models.BigIntegerField(),
+            ),
+            last_activity_at=Case(
+                When(is_newest, then=Value(newest.sent_at)),
+                default=F("last_activity_at"),
+                output_field=models.DateTimeField(),
+            ),
+        )
+
+    @classmethod
+    def refresh_activity(cls, chat_id):
+        """Recompute the last message fields of a chat from its messages"""
+        messages = Message.objects.filter(chat_id=chat_id)
+        newest = messages.order_by("-seq").first()
+        cls.objects.filter(pk=chat_id).update(
+            last_message=newest,
+            last_activity_at=(
+                newest.sent_at if newest is not None else F("created_at")
+            ),
+            message_count=messages.count(),
+        )
+
 
 class ChatParticipant(models.Model):
     chat = models.ForeignKey(
@@ -22,6 +116,21 @@ class ChatParticipant(models.Model):
         related_name="chat_participants",
     )
     joined_at = models.DateTimeField(default=timezone.now)
+    # Receipt watermarks used when CHAT_RECEIPT_MODE is "watermark"
+    last_delivered_message = models.ForeignKey(
+        "Message",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    last_read_message = models.ForeignKey(
+        "Message",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
 
     class Meta:
         unique_together = ("chat", "user")
@@ -44,12 +153,30 @@ class Message(models.Model):
     content = models.TextField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="sent")
     sent_at = models.DateTimeField(default=timezone.now)
+    # Gapless, per chat position of the message, assigned on insert
+    seq = models.PositiveBigIntegerField(editable=False)
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:20]}"
 
+    def save(self, *args, **kwargs):
+        if self.seq is not None:
+            return super().save(*args, **kwargs)
+
+        # The chat row stays locked until the insert commits, so concurrent
+        # writers get consecutive numbers and a rollback frees it
+        with transaction.atomic():
+            self.seq = Chat.lock_message_seq(self.chat_id) + 1
+            super().save(*args, **kwargs)
+            Chat.record_messages(self.chat_id, [self])
+
     class Meta:
         ordering = ["sent_at"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat", "seq"], name="chat_message_seq_unique"
+            )
+        ]
 
 
 class MessageStatus(models.Model):
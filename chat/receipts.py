@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from .models import ChatParticipant, Message, MessageStatus
+
+# Statuses a receipt may move out of for each target status
+TRANSITIONS = {
+    "delivered": ["sent"],
+    "read": ["sent", "delivered"],
+}
+
+
+def uses_watermarks():
+    """Whether receipts are tracked as per-participant cursors"""
+    return getattr(settings, "CHAT_RECEIPT_MODE", "status") == "watermark"
+
+
+def mark_chat_messages(chat_id, user, new_status, up_to=None):
+    """
+    Move every receipt the user holds in a chat to ``new_status``.
+
+    ``up_to`` limits the transition to messages with an id lower or equal to
+    it. Returns a list of ``(message_id, sender_id, seq)`` tuples for the
+    receipts that actually changed, ready for ``notify_message_status_batch``.
+    """
+    if uses_watermarks():
+        return _advance_watermarks(chat_id, user, new_status, up_to)
+
+    with transaction.atomic():
+        statuses = MessageStatus.objects.select_for_update(of=("self",)).filter(
+            message__chat_id=chat_id,
+            receiver=user,
+            status__in=TRANSITIONS[new_status],
+        )
+        if up_to is not None:
+            statuses = statuses.filter(message_id__lte=up_to)
+
+        changed = list(
+            statuses.order_by("message_id").values_list(
+                "id", "message_id", "message__sender_id", "message__seq"
+            )
+        )
+        if changed:
+            MessageStatus.objects.filter(
+                id__in=[status_id for status_id, *_ in changed]
+            ).update(status=new_status, updated_at=timezone.now())
+
+    return [tuple(row[1:]) for row in changed]
+
+
+def _advance_watermarks(chat_id, user, new_status, up_to=None):
+    """Move the participant's cursors forward, never backwards"""
+    with transaction.atomic():
+        participant = (
+            ChatParticipant.objects.select_for_update()
+            .filter(chat_id=chat_id, user=user)
+            .first()
+        )
+        if participant is None:
+            return []
+
+        incoming = Message.objects.filter(chat_id=chat_id).exclude(sender=user)
+        if up_to is not None:
+            incoming = incoming.filter(id__lte=up_to)
+        latest_id = incoming.aggregate(latest=Max("id"))["latest"]
+        if latest_id is None:
+            return []
+
+        if new_status == "read":
+            current = participant.last_read_message_id or 0
+        else:
+            current = participant.last_delivered_message_id or 0
+        if current >= latest_id:
+            return []
+
+        # Reading a message implies it was delivered
+        updates = {}
+        if new_status == "read":
+            updates["last_read_message_id"] = latest_id
+        if (participant.last_delivered_message_id or 0) < latest_id:
+            updates["last_delivered_message_id"] = latest_id
+        ChatParticipant.objects.filter(pk=participant.pk).update(**updates)
+
+        # Exactly the messages the cursor moved over, not later arrivals
+        return list(
+            incoming.filter(id__gt=current, id__lte=latest_id)
+            .order_by("id")
+            .values_list("id", "sender_id", "seq")
+        )
+
+
+def watermark_status(participant, message_id):
+    """Receipt status of a message for a participant, derived from cursors"""
+    if (participant.last_read_message_id or 0) >= message_id:
+        return "read"
+    if (participant.last_delivered_message_id or 0) >= message_id:
+        return "delivered"
+    return "sent"
+
+
+def message_receivers(message, participants):
+    """Participants that were expected to receive a message"""
+    return [
+        participant
+        for participant in participants
+        if participant.user_id != message.sender_id
+        and participant.joined_at <= message.sent_at
+    ]
@@ -0,0 +1,117 @@
+from django.conf import settings
+from .models import Chat, ChatParticipant, Message, MessageStatus
+from .receipts import uses_watermarks
+from .services import message_payload, pending_seqs, uses_write_behind
+from .tasks import status_batch_event
+
+
+def seq_for_message(chat_id, message_id):
+    """Sequence number of a message, or of the last one before it if gone"""
+    seq = (
+        Message.objects.filter(chat_id=chat_id, id__lte=message_id)
+        .order_by("-seq")
+        .values_list("seq", flat=True)
+        .first()
+    )
+    return seq or 0
+
+
+def missed_messages(chat_id, after_seq, limit=None):
+    """
+    Return up to ``limit`` messages of a chat that follow ``after_seq``, and
+    whether the replay is held at a write-behind message not stored yet.
+
+    Messages are returned in sequence order so callers can page through a
+    gap by passing the ``seq`` of the last message of the previous page.
+    The page stops before the first pending seq: replaying past it would
+    move the client's cursor beyond a message it never received. Seqs of
+    messages that failed or were lost are skipped.
+    """
+    limit = limit or settings.WS_REPLAY_PAGE_SIZE
+    messages = list(
+        Message.objects.filter(chat_id=chat_id, seq__gt=after_seq)
+        .select_related("sender")
+        .order_by("seq")[:limit]
+    )
+
+    held = False
+    if uses_write_behind():
+        if len(messages) == limit:
+            end = messages[-1].seq
+        else:
+            # Seqs reserved after the last stored message may still be coming
+            end = (
+                Chat.objects.filter(pk=chat_id)
+                .values_list("last_message_seq", flat=True)
+                .first()
+                or 0
+            )
+        stored = {message.seq for message in messages}
+        pending = pending_seqs(
+            chat_id,
+            [seq for seq in range(after_seq + 1, end + 1) if seq not in stored],
+        )
+        if pending:
+            held = True
+            messages = [message for message in messages if message.seq < min(pending)]
+
+    return [message_payload(message) for message in messages], held
+
+
+def missed_receipts(chat_id, user, after_seq):
+    """
+    Receipt events a user missed on their own messages since ``after_seq``.
+
+    In status mode this returns ``mensaje_estado`` events, batched per
+    receiver and status, for the receipts updated after the message at the
+    cursor was sent. In watermark mode it returns a single ``receipts`` frame with
+    every participant's cursors.
+    """
+    if uses_watermarks():
+        participants = ChatParticipant.objects.filter(chat_id=chat_id).values_list(
+            "user_id", "last_delivered_message_id", "last_read_message_id"
+        )
+        return [
+            {
+                "type": "receipts",
+                "chat_id": chat_id,
+                "participants": [
+                    {
+                        "user_id": user_id,
+                        "last_delivered_message_id": delivered_id,
+                        "last_read_message_id": read_id,
+                    }
+                    for user_id, delivered_id, read_id in participants
+                ],
+            }
+        ]
+
+    since = (
+        Message.objects.filter(chat_id=chat_id, seq=after_seq)
+        .values_list("sent_at", flat=True)
+        .first()
+    )
+    if since is None:
+        return []
+
+    statuses = (
+        MessageStatus.objects.filter(
+            message__chat_id=chat_id,
+            message__sender=user,
+            updated_at__gte=since,
+        )
+        .exclude(status="sent")
+        .order_by("message_id")
+        .values_list("receiver_id", "status", "message_id", "message__seq")[
+            : settings.WS_REPLAY_LIMIT
+        ]
+    )
+
+    grouped = {}
+    for receiver_id, status, message_id, seq in statuses:
+        grouped.setdefault((receiver_id, status), []).append((message_id, seq))
+
+    return [
+        status_batch_event(chat_id, receiver_id, status, messages)
+        for (receiver_id, status), messages in grouped.items()
+    ]
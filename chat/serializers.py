@@ -1,5 +1,7 @@
 from rest_framework import serializers
+from django.db.models import Prefetch, prefetch_related_objects
 from .models import Chat, ChatParticipant, Message, MessageStatus
+from .receipts import message_receivers, uses_watermarks, watermark_status
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -21,14 +23,55 @@ class MessageStatusSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserMinimalSerializer(read_only=True)
-    statuses = MessageStatusSerializer(
-        source="receiver_statuses", many=True, read_only=True
-    )
+    statuses = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ["id", "chat", "sender", "content", "status", "sent_at", "statuses"]
-        read_only_fields = ["sent_at", "status"]
+        fields = [
+            "id",
+            "chat",
+            "sender",
+            "content",
+            "status",
+            "sent_at",
+            "seq",
+            "statuses",
+        ]
+        read_only_fields = ["sent_at", "status", "seq"]
+
+    def get_statuses(self, obj):
+        if not uses_watermarks():
+            return MessageStatusSerializer(obj.receiver_statuses.all(), many=True).data
+
+        # Derive one status per receiver from the participants' cursors
+        return [
+            {
+                "id": None,
+                "receiver": UserMinimalSerializer(participant.user).data,
+                "status": watermark_status(participant, obj.id),
+                "updated_at": None,
+            }
+            for participant in message_receivers(
+                obj, self._chat_participants(obj.chat_id)
+            )
+        ]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # "Read by N" summary computed from the receipts already serialized
+        data["read_by"] = sum(
+            1 for receipt in data["statuses"] if receipt["status"] == "read"
+        )
+        return data
+
+    def _chat_participants(self, chat_id):
+        """Participants of a chat, fetched once per serializer context"""
+        cache = self.context.setdefault("chat_participants", {})
+        if chat_id not in cache:
+            cache[chat_id] = list(
+                ChatParticipant.objects.filter(chat_id=chat_id).select_related("user")
+            )
+        return cache[chat_id]
 
 
 class ChatParticipantSerializer(serializers.ModelSerializer):
@@ -39,20 +82,68 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
         fields = ["id", "chat", "user", "joined_at"]
 
 
+def load_chat_previews(chats, context):
+    """
+    Load the participants and last message of many chats at once.
+
+    Participants are prefetched with their users and the last messages of
+    all chats, found through ``Chat.last_message``, with a single query, so
+    serializing the chats runs the same number of queries however many
+    there are.
+    """
+    messages = Message.objects.select_related("sender")
+    if not uses_watermarks():
+        messages = messages.prefetch_related("receiver_statuses__receiver")
+    prefetch_related_objects(
+        chats,
+        Prefetch(
+            "participants", queryset=ChatParticipant.objects.select_related("user")
+        ),
+        Prefetch("last_message", queryset=messages),
+    )
+
+    # Reused by MessageSerializer for watermark receipts
+    cache = context.setdefault("chat_participants", {})
+    for chat in chats:
+        cache[chat.id] = list(chat.participants.all())
+
+
+class ChatListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        chats = list(data.all() if hasattr(data, "all") else data)
+        if chats:
+            load_chat_previews(chats, self.context)
+        return super().to_representation(chats)
+
+
 class ChatSerializer(serializers.ModelSerializer):
     participants = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
 
     class Meta:
         model = Chat
-        fields = ["id", "name", "created_at", "active", "participants", "last_message"]
+        fields = [
+            "id",
+            "name",
+            "created_at",
+            "active",
+            "participants",
+            "last_message",
+            "last_activity_at",
+            "message_count",
+        ]
+        read_only_fields = ["last_activity_at", "message_count"]
+        list_serializer_class = ChatListSerializer
 
     def get_participants(self, obj):
-        participants = ChatParticipant.objects.filter(chat=obj)
+        if "participants" in getattr(obj, "_prefetched_objects_cache", {}):
+            participants = obj.participants.all()
+        else:
+            participants = obj.participants.select_related("user")
         return ChatParticipantSerializer(participants, many=True).data
 
     def get_last_message(self, obj):
-        message = obj.messages.order_by("-sent_at").first()
+        message = obj.last_message
         if message:
-            return MessageSerializer(message).data
+            return MessageSerializer(message, context=self.context).data
         return None
@@ -0,0 +1,211 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from socket_handlers.protocol import broadcast
+from .ids import next_message_id
+from .models import Chat, ChatParticipant, Message, MessageStatus
+from .receipts import uses_watermarks
+
+
+def uses_write_behind():
+    """Whether socket messages are broadcast before they are stored"""
+    return getattr(settings, "CHAT_WRITE_BEHIND", False)
+
+
+def _pending_key(chat_id, seq):
+    return f"chat:pending:{chat_id}:{seq}"
+
+
+def mark_pending(message):
+    """Record in the shared cache that a message's seq is not stored yet"""
+    try:
+        cache.set(
+            _pending_key(message.chat_id, message.seq),
+            1,
+            getattr(settings, "WRITE_BEHIND_PENDING_TTL", 30),
+        )
+    except Exception as e:
+        print(f"Pending message cache error: {e}")
+
+
+def clear_pending(messages):
+    """Forget the pending seqs of messages that were stored or given up on"""
+    try:
+        cache.delete_many(
+            [_pending_key(message.chat_id, message.seq) for message in messages]
+        )
+    except Exception as e:
+        print(f"Pending message cache error: {e}")
+
+
+def pending_seqs(chat_id, seqs):
+    """The ones of ``seqs`` reserved by write-behind messages not stored yet"""
+    if not seqs:
+        return set()
+    keys = {_pending_key(chat_id, seq): seq for seq in seqs}
+    try:
+        found = cache.get_many(list(keys))
+    except Exception as e:
+        print(f"Pending message cache error: {e}")
+        return set()
+    return {keys[key] for key in found}
+
+
+def unstored_seqs(chat_id, window=100):
+    """
+    Pending seqs among the latest ``window`` reserved in a chat.
+
+    These are write-behind messages clients may have seen but that receipts
+    cannot reach yet.
+    """
+    last_seq = (
+        Chat.objects.filter(pk=chat_id)
+        .values_list("last_message_seq", flat=True)
+        .first()
+        or 0
+    )
+    first_seq = max(last_seq - window, 0) + 1
+    stored = set(
+        Message.objects.filter(chat_id=chat_id, seq__gte=first_seq).values_list(
+            "seq", flat=True
+        )
+    )
+    return pending_seqs(
+        chat_id, [seq for seq in range(first_seq, last_seq + 1) if seq not in stored]
+    )
+
+
+def receiver_ids_for(chat_id, sender_id):
+    """
+    Users a new message fans out to, read from the database.
+
+    Runs inside the message's transaction: the membership caches may lag
+    behind a participant added on another worker, and the receipts written
+    from this list are permanent.
+    """
+    return sorted(
+        ChatParticipant.objects.filter(chat_id=chat_id)
+        .exclude(user_id=sender_id)
+        .values_list("user_id", flat=True)
+    )
+
+
+def create_message(chat_id, sender, content):
+    """
+    Persist a message and its receipts in a single transaction.
+
+    The caller is expected to have checked that ``sender`` participates in
+    the chat. Receipt rows for every other participant are written with
+    one ``bulk_create``. The returned message carries ``receiver_ids`` with the
+    users it was fanned out to.
+    """
+    chat_id = int(chat_id)
+
+    # Keep ids time ordered alongside the ones handed out by write-behind
+    message_id = next_message_id() if uses_write_behind() else None
+
+    with transaction.atomic():
+        message = Message.objects.create(
+            id=message_id, chat_id=chat_id, sender=sender, content=content
+        )
+
+        receiver_ids = receiver_ids_for(chat_id, sender.id)
+
+        # Create message status entries for all participants except sender
+        if not uses_watermarks():
+            MessageStatus.objects.bulk_create(
+                [
+                    MessageStatus(message=message, receiver_id=receiver_id)
+                    for receiver_id in receiver_ids
+                ]
+            )
+
+    message.receiver_ids = receiver_ids
+    return message
+
+
+def prepare_message(chat_id, sender, content):
+    """
+    Build an unsaved message for write-behind persistence.
+
+    The message gets an application generated id and its chat sequence
+    number right away, so it can be broadcast before ``persist_messages``
+    stores it. Until then its seq is marked pending, which holds replays
+    before it.
+    """
+    chat_id = int(chat_id)
+
+    with transaction.atomic():
+        seq = Chat.allocate_message_seq(chat_id)
+        message = Message(
+            id=next_message_id(),
+            chat_id=chat_id,
+            sender=sender,
+            content=content,
+            seq=seq,
+        )
+        # Marked before the seq is visible, so no replay can pass it
+        mark_pending(message)
+        message.receiver_ids = receiver_ids_for(chat_id, sender.id)
+
+    return message
+
+
+def persist_messages(messages):
+    """Store prepared messages and their receipts in a single transaction"""
+    by_chat = {}
+    for message in messages:
+        by_chat.setdefault(message.chat_id, []).append(message)
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        for chat_id, chat_messages in by_chat.items():
+            Chat.record_messages(chat_id, chat_messages)
+
+        if not uses_watermarks():
+            MessageStatus.objects.bulk_create(
+                [
+                    MessageStatus(message=message, receiver_id=receiver_id)
+                    for message in messages
+                    for receiver_id in message.receiver_ids
+                ]
+            )
+
+    clear_pending(messages)
+
+
+def message_payload(message):
+    """Client representation of a message in WebSocket frames"""
+    return {
+        "id": message.id,
+        "content": message.content,
+        "sender_id": message.sender.id,
+        "sender_username": message.sender.username,
+        "sender_profile_img": getattr(message.sender, "profile_img", None),
+        "sent_at": message.sent_at.isoformat(),
+        "status": message.status,
+        "chat_id": message.chat_id,
+        "seq": message.seq,
+    }
+
+
+def message_event(message, payload=None):
+    """
+    Channel layer payload announcing a message to its chat group.
+
+    ``payload`` replaces the WebSocket representation of the message, e.g.
+    with the REST serializer's when the message was posted over REST.
+    """
+    if payload is None:
+        payload = message_payload(message)
+    event = broadcast(
+        {
+            "type": "chat_message",
+            "chat_id": message.chat_id,
+            "message": payload,
+        },
+        handler="chat.message",
+    )
+    # Lets resuming sockets skip messages they already replayed
+    event.update(chat_id=message.chat_id, seq=message.seq)
+    return event
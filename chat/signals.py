@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .membership import invalidate_members
+from .models import ChatParticipant
+
+
+@receiver(post_save, sender=ChatParticipant)
+@receiver(post_delete, sender=ChatParticipant)
+def invalidate_chat_members(sender, instance, **kwargs):
+    """Drop the cached member set whenever a participant changes"""
+    chat_id = instance.chat_id
+    invalidate_members(chat_id)
+    # Readers inside the transaction window may have cached the old set
+    transaction.on_commit(lambda: invalidate_members(chat_id))
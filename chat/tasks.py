@@ -1,39 +1,126 @@
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import MessageStatus
+from core.tasks import get_task_queue, register_task
+from socket_handlers.layers import group_send
+from socket_handlers.presence import get_presence
+from socket_handlers.protocol import broadcast
 
 
-def notify_message_status_change(status_id):
-    """Notify about message status changes"""
-    try:
-        status_obj = MessageStatus.objects.select_related("message", "receiver").get(
-            id=status_id
-        )
-        channel_layer = get_channel_layer()
+def notify_message_status_change(message, receiver_id, status):
+    """Notify about a single receipt changing status"""
+    notify_message_status_batch(
+        message.chat_id,
+        receiver_id,
+        status,
+        [(message.id, message.sender_id, message.seq)],
+    )
 
-        # Notify the chat room
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{status_obj.message.chat.id}",
-            {
-                "type": "chat.event",
-                "event": "mensaje_estado",
-                "message_id": status_obj.message.id,
-                "user_id": status_obj.receiver.id,
-                "status": status_obj.status,
-            },
-        )
 
-        # Also notify the message sender specifically
-        async_to_sync(channel_layer.group_send)(
-            f"user_{status_obj.message.sender.id}",
+def status_batch_event(chat_id, receiver_id, status, messages):
+    """
+    ``mensaje_estado`` payload for several messages moving to one status.
+
+    ``messages`` is a list of ``(message_id, seq)`` pairs of the same chat.
+    """
+    messages = sorted(messages)
+    event = {
+        "type": "chat.event",
+        "event": "mensaje_estado",
+        "chat_id": chat_id,
+        "user_id": receiver_id,
+        "status": status,
+        "message_ids": [message_id for message_id, _ in messages],
+        "from_message_id": messages[0][0],
+        "to_message_id": messages[-1][0],
+        "from_seq": messages[0][1],
+        "to_seq": messages[-1][1],
+    }
+    if len(messages) == 1:
+        # Same fields as the single message notification
+        event["message_id"], event["seq"] = messages[0]
+    return event
+
+
+def notify_message_status_batch(chat_id, receiver_id, status, changes):
+    """
+    Queue notifications for a set of receipts that moved to the same status.
+
+    ``changes`` is a list of ``(message_id, sender_id, seq)`` tuples. The
+    notifications are sent by ``send_message_status`` in the background.
+    """
+    if not changes:
+        return
+
+    try:
+        get_task_queue().enqueue(
+            "message_status",
             {
-                "type": "chat.event",
-                "event": "mensaje_estado",
-                "message_id": status_obj.message.id,
-                "chat_id": status_obj.message.chat.id,
-                "user_id": status_obj.receiver.id,
-                "status": status_obj.status,
+                "chat_id": int(chat_id),
+                "receiver_id": receiver_id,
+                "status": status,
+                "changes": [list(change) for change in changes],
             },
         )
     except Exception as e:
-        print(f"Error notifying message status change: {e}")
+        print(f"Error queueing message status change: {e}")
+
+
+@register_task("message_status")
+async def send_message_status(payloads):
+    """
+    Broadcast queued receipt changes.
+
+    Changes are merged per chat, receiver and status, and a delivered
+    receipt is dropped when the same batch already marks the message read.
+    The chat room then gets a single event per receiver and status, and
+    each sender that is not online in the chat gets one event with the ids
+    of their own messages.
+    """
+    merged = {}
+    for payload in payloads:
+        key = (payload["chat_id"], payload["receiver_id"], payload["status"])
+        changes = merged.setdefault(key, {})
+        for message_id, sender_id, seq in payload["changes"]:
+            changes[message_id] = (message_id, sender_id, seq)
+
+    for (chat_id, receiver_id, status), changes in merged.items():
+        if status == "delivered":
+            for message_id in merged.get((chat_id, receiver_id, "read"), {}):
+                changes.pop(message_id, None)
+
+    channel_layer = get_channel_layer()
+    online = await get_presence().online_users(
+        sorted({chat_id for chat_id, _, _ in merged})
+    )
+    for (chat_id, receiver_id, status), changes in merged.items():
+        if not changes:
+            continue
+
+        by_sender = {}
+        for message_id, sender_id, seq in changes.values():
+            by_sender.setdefault(sender_id, []).append((message_id, seq))
+
+        # Notify the chat room
+        await group_send(
+            channel_layer,
+            f"chat_{chat_id}",
+            broadcast(
+                status_batch_event(
+                    chat_id,
+                    receiver_id,
+                    status,
+                    [(message_id, seq) for message_id, _, seq in changes.values()],
+                )
+            ),
+        )
+
+        # Senders online in the chat already got the room's copy
+        present = set(online.get(chat_id, ()))
+        for sender_id, messages in by_sender.items():
+            if sender_id == receiver_id or sender_id in present:
+                continue
+            event = broadcast(
+                status_batch_event(chat_id, receiver_id, status, messages)
+            )
+            # Sockets following the chat without being registered yet skip it
+            event.update(chat_id=chat_id, user_copy=True)
+            await group_send(channel_layer, f"user_{sender_id}", event)
@@ -1,3 +1,354 @@
-from django.test import TestCase
+import asyncio
+import json
+import unittest
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from core.tasks import (
+    REQUEUE_DUE_SCRIPT,
+    TASK_HANDLERS,
+    InProcessTaskQueue,
+    RedisTaskQueue,
+)
+from .ids import NodeLease
+from .membership import chat_members
+from .models import Chat, ChatParticipant, Message, MessageStatus
+from .receipts import mark_chat_messages
+from .replay import missed_messages
+from .services import clear_pending, create_message, persist_messages, prepare_message
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+User = get_user_model()
+
+
+class MessageSeqTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender", email="sender@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        ChatParticipant.objects.create(chat=self.chat, user=self.sender)
+
+    def test_seqs_count_up_per_chat(self):
+        other = Chat.objects.create(name="other")
+        seqs = [
+            create_message(chat.id, self.sender, "hi").seq
+            for chat in (self.chat, self.chat, other, self.chat)
+        ]
+        self.assertEqual(seqs, [1, 2, 1, 3])
+
+    def test_rolled_back_message_frees_its_seq(self):
+        create_message(self.chat.id, self.sender, "first")
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                create_message(self.chat.id, self.sender, "lost")
+                raise RuntimeError("rollback")
+
+        message = create_message(self.chat.id, self.sender, "second")
+
+        self.assertEqual(message.seq, 2)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_seq, 2)
+        self.assertEqual(self.chat.message_count, 2)
+
+
+class MissedMessagesTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender", email="sender@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        ChatParticipant.objects.create(chat=self.chat, user=self.sender)
+        for text in "abcde":
+            create_message(self.chat.id, self.sender, text)
+
+    def test_pages_follow_the_cursor(self):
+        pages = []
+        cursor = 1
+        while True:
+            page, held = missed_messages(self.chat.id, cursor, 2)
+            self.assertFalse(held)
+            if not page:
+                break
+            pages.append([message["seq"] for message in page])
+            cursor = page[-1]["seq"]
+
+        self.assertEqual(pages, [[2, 3], [4, 5]])
+
+    def test_deleted_messages_are_skipped(self):
+        Message.objects.filter(chat=self.chat, seq=2).delete()
+
+        page, _ = missed_messages(self.chat.id, 0, 3)
+
+        self.assertEqual([message["seq"] for message in page], [1, 3, 4])
+
+
+@override_settings(CHAT_WRITE_BEHIND=True)
+class ReplayPendingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="sender", email="sender@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        ChatParticipant.objects.create(chat=self.chat, user=self.user)
+
+    def replayed_seqs(self):
+        page, held = missed_messages(self.chat.id, 0, 100)
+        return [message["seq"] for message in page], held
+
+    def test_replay_stops_before_pending_message(self):
+        create_message(self.chat.id, self.user, "first")
+        pending = prepare_message(self.chat.id, self.user, "second")
+        create_message(self.chat.id, self.user, "third")
+
+        self.assertEqual(self.replayed_seqs(), ([1], True))
+
+        persist_messages([pending])
+        self.assertEqual(self.replayed_seqs(), ([1, 2, 3], False))
+
+    def test_chat_points_at_the_highest_seq(self):
+        first = prepare_message(self.chat.id, self.user, "first")
+        second = prepare_message(self.chat.id, self.user, "second")
+        # Written by a process whose clock runs behind
+        second.sent_at = first.sent_at - timedelta(minutes=5)
+
+        persist_messages([second])
+        persist_messages([first])
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, second.id)
+        self.assertEqual(self.chat.last_activity_at, second.sent_at)
+        self.assertEqual(self.chat.message_count, 2)
+
+    def test_failed_message_leaves_a_gap(self):
+        create_message(self.chat.id, self.user, "first")
+        failed = prepare_message(self.chat.id, self.user, "lost")
+        create_message(self.chat.id, self.user, "third")
+
+        clear_pending([failed])
+        self.assertEqual(self.replayed_seqs(), ([1, 3], False))
+
+
+class CreateMessageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username="sender", email="sender@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        ChatParticipant.objects.create(chat=self.chat, user=self.sender)
+
+    def test_receivers_come_from_the_database(self):
+        chat_members(self.chat.id)
+        # Added behind the cache's back, as another worker would
+        receiver = User.objects.create(username="late", email="late@test.local")
+        ChatParticipant.objects.bulk_create(
+            [ChatParticipant(chat=self.chat, user=receiver)]
+        )
+
+        message = create_message(self.chat.id, self.sender, "hi")
+
+        self.assertEqual(message.receiver_ids, [receiver.id])
+        self.assertTrue(
+            MessageStatus.objects.filter(message=message, receiver=receiver).exists()
+        )
+
+
+class StatusReceiptTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender", email="sender@test.local")
+        self.reader = User.objects.create(username="reader", email="reader@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        for user in (self.sender, self.reader):
+            ChatParticipant.objects.create(chat=self.chat, user=user)
+        self.messages = [
+            create_message(self.chat.id, self.sender, text) for text in "abc"
+        ]
+
+    def statuses(self):
+        return list(
+            MessageStatus.objects.filter(receiver=self.reader)
+            .order_by("message_id")
+            .values_list("status", flat=True)
+        )
+
+    def test_receipts_only_move_forward(self):
+        first = self.messages[0]
+        changes = mark_chat_messages(self.chat.id, self.reader, "read", up_to=first.id)
+        self.assertEqual(changes, [(first.id, self.sender.id, first.seq)])
+
+        changes = mark_chat_messages(self.chat.id, self.reader, "delivered")
+        self.assertEqual(
+            [message_id for message_id, *_ in changes],
+            [message.id for message in self.messages[1:]],
+        )
+        self.assertEqual(self.statuses(), ["read", "delivered", "delivered"])
+
+    def test_unchanged_receipts_are_not_reported(self):
+        mark_chat_messages(self.chat.id, self.reader, "read")
+
+        self.assertEqual(mark_chat_messages(self.chat.id, self.reader, "read"), [])
+        self.assertEqual(mark_chat_messages(self.chat.id, self.reader, "delivered"), [])
+
+
+@override_settings(CHAT_RECEIPT_MODE="watermark")
+class WatermarkReceiptTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username="sender", email="sender@test.local")
+        self.reader = User.objects.create(username="reader", email="reader@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        for user in (self.sender, self.reader):
+            ChatParticipant.objects.create(chat=self.chat, user=user)
+        self.messages = [
+            create_message(self.chat.id, self.sender, text) for text in "abc"
+        ]
+
+    def cursors(self):
+        participant = ChatParticipant.objects.get(chat=self.chat, user=self.reader)
+        return participant.last_delivered_message_id, participant.last_read_message_id
+
+    def test_reports_only_the_messages_the_cursor_moved_over(self):
+        first, second, third = self.messages
+        changes = mark_chat_messages(self.chat.id, self.reader, "read", up_to=first.id)
+        self.assertEqual(changes, [(first.id, self.sender.id, first.seq)])
+
+        changes = mark_chat_messages(self.chat.id, self.reader, "read")
+        self.assertEqual(
+            [message_id for message_id, *_ in changes], [second.id, third.id]
+        )
+        self.assertEqual(self.cursors(), (third.id, third.id))
+
+    def test_cursor_never_moves_back(self):
+        third = self.messages[-1]
+        mark_chat_messages(self.chat.id, self.reader, "delivered")
+
+        changes = mark_chat_messages(
+            self.chat.id, self.reader, "delivered", up_to=self.messages[0].id
+        )
+        self.assertEqual(changes, [])
+        self.assertEqual(self.cursors(), (third.id, None))
+
+    def test_status_sent_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        mark_chat_messages(self.chat.id, self.reader, "delivered")
+
+        response = client.put(
+            reverse("message-status", args=[self.messages[-1].id]),
+            {"status": "sent"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.cursors()[0], self.messages[-1].id)
+
+
+class NodeLeaseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_processes_get_distinct_nodes(self):
+        nodes = {NodeLease().current() for _ in range(3)}
+        self.assertEqual(nodes, {0, 1, 2})
+
+    def test_lease_taken_over_is_replaced(self):
+        lease = NodeLease(ttl=60)
+        node = lease.current()
+        cache.set(lease._key(node), "other process")
+        lease.renew_at = 0
+
+        self.assertNotEqual(lease.current(), node)
+
+
+class TaskQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.runs = []
+        TASK_HANDLERS["test_task"] = self.handler
+        self.addCleanup(TASK_HANDLERS.pop, "test_task")
+        self.queue = InProcessTaskQueue(max_retries=2)
+        self.retries = []
+
+        async def retry(items, delay):
+            self.retries.extend(items)
+
+        self.queue.retry = retry
+
+    async def handler(self, payloads):
+        self.runs.append(payloads)
+        if "poison" in payloads:
+            raise ValueError("bad payload")
+
+    async def test_poison_payload_only_spends_its_own_retries(self):
+        with self.assertLogs("core.tasks", "WARNING"):
+            await self.queue.process(
+                [
+                    ("test_task", "good", 0, 0),
+                    ("test_task", "poison", 1, 0),
+                    ("test_task", "other", 0, 0),
+                ]
+            )
+
+        self.assertEqual(self.queue.processed, 2)
+        self.assertEqual([payload for _, payload, _, _ in self.retries], ["poison"])
+        self.assertEqual(self.retries[0][2], 2)
+
+    async def test_payload_fails_after_max_retries(self):
+        with self.assertLogs("core.tasks", "ERROR"):
+            await self.queue.process([("test_task", "poison", 2, 0)])
+
+        self.assertEqual(self.retries, [])
+        self.assertEqual(self.queue.failed, 1)
+
+
+@unittest.skipUnless(fakeredis, "fakeredis is not installed")
+class RedisTaskQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.runs = []
+        TASK_HANDLERS["test_task"] = self.handler
+        self.addCleanup(TASK_HANDLERS.pop, "test_task")
+        self.queue = RedisTaskQueue("redis://fake", retry_delay=0)
+        self.server = fakeredis.FakeServer()
+
+    def redis(self):
+        """Fake Redis client of the running loop, shared with the queue"""
+        client = fakeredis.aioredis.FakeRedis(server=self.server)
+        self.queue._clients[asyncio.get_running_loop()] = client
+        return client
+
+    async def handler(self, payloads):
+        self.runs.append(payloads)
+        if len(self.runs) == 1:
+            raise ValueError("first run fails")
+
+    async def test_tasks_of_dead_workers_are_requeued(self):
+        client = self.redis()
+        for worker in ("dead", "alive"):
+            await client.sadd(self.queue.workers_key, worker)
+            await client.rpush(self.queue._processing_key(worker), worker)
+        await client.set(self.queue._heartbeat_key("alive"), 1)
+
+        await self.queue.recover(client)
+
+        self.assertEqual(await client.lrange(self.queue.key, 0, -1), [b"dead"])
+        self.assertEqual(await client.smembers(self.queue.workers_key), {b"alive"})
+        self.assertEqual(await client.llen(self.queue._processing_key("alive")), 1)
+
+    async def test_failed_task_is_queued_again_when_due(self):
+        client = self.redis()
+        with self.assertLogs("core.tasks", "ERROR"):
+            await self.queue.process([("test_task", "payload", 0, 0)])
+        self.assertEqual(await client.llen(self.queue.key), 0)
+
+        await client.eval(
+            REQUEUE_DUE_SCRIPT, 2, self.queue.delayed_key, self.queue.key, 2e9, 10
+        )
+
+        (raw,) = await client.lrange(self.queue.key, 0, -1)
+        name, payload, attempt, _ = json.loads(raw)
+        self.assertEqual((name, payload, attempt), ("test_task", "payload", 1))
+        self.assertEqual(await client.zcard(self.queue.delayed_key), 0)
+
+        await self.queue.process([tuple(json.loads(raw))])
+        self.assertEqual(self.runs, [["payload"], ["payload"]])
+        self.assertEqual(self.queue.processed, 1)
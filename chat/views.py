@@ -2,15 +2,23 @@ from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from .models import Chat, ChatParticipant, Message, MessageStatus
+from .membership import chat_members, is_member
+from .receipts import mark_chat_messages, uses_watermarks
+from .services import create_message, message_event
+from .tasks import notify_message_status_batch, notify_message_status_change
 from .serializers import (
     ChatSerializer,
     MessageSerializer,
     ChatParticipantSerializer,
     MessageStatusSerializer,
 )
+from django.db import transaction
 from django.db.models import Q
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from socket_handlers.layers import group_send
+from socket_handlers.presence import get_presence
+from socket_handlers.protocol import broadcast
 import json
 
 
@@ -25,10 +33,15 @@ class ChatViewSet(viewsets.ModelViewSet):
     search_fields = ["name"]
 
     def get_queryset(self):
-        """Get chats where the current user is a participant"""
+        """Get chats where the current user is a participant, most recently
+        active first"""
         user = self.request.user
         # Only return active chats
-        return Chat.objects.filter(participants__user=user, active=True).distinct()
+        return (
+            Chat.objects.filter(participants__user=user, active=True)
+            .distinct()
+            .order_by("-last_activity_at", "-id")
+        )
 
     def perform_create(self, serializer):
         """Create a new chat and add participants"""
@@ -71,7 +84,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         chat = self.get_object()
 
         # Check if the current user is a participant
-        if not ChatParticipant.objects.filter(chat=chat, user=request.user).exists():
+        if not is_member(chat.id, request.user.id):
             return Response(
                 {"detail": "You are not a participant in this chat."},
                 status=status.HTTP_403_FORBIDDEN,
@@ -92,17 +105,19 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         User = get_user_model()
 
+        members = set(chat_members(chat.id))
         added_count = 0
         for user_id in users_ids:
             try:
                 user = User.objects.get(id=user_id)
 
                 # Skip if already a participant
-                if ChatParticipant.objects.filter(chat=chat, user=user).exists():
+                if user.id in members:
                     continue
 
                 # Add as participant
                 ChatParticipant.objects.create(chat=chat, user=user)
+                members.add(user.id)
                 added_count += 1
 
                 # Notify the user about being added to the chat
@@ -131,7 +146,7 @@ class ChatViewSet(viewsets.ModelViewSet):
         chat = self.get_object()
 
         # Check if the current user is a participant
-        if not ChatParticipant.objects.filter(chat=chat, user=request.user).exists():
+        if not is_member(chat.id, request.user.id):
             return Response(
                 {"detail": "You are not a participant in this chat."},
                 status=status.HTTP_403_FORBIDDEN,
@@ -149,7 +164,7 @@ class ChatViewSet(viewsets.ModelViewSet):
             Message.objects.filter(chat=chat)
             .select_related("sender")
             .prefetch_related("receiver_statuses", "receiver_statuses__receiver")
-            .order_by("-sent_at")[start:end]
+            .order_by("-seq")[start:end]
         )
 
         serializer = MessageSerializer(messages, many=True)
@@ -159,6 +174,36 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data)
 
+    @action(detail=False, methods=["get"])
+    def online(self, request):
+        """Get the online users of the current user's chats"""
+        chat_ids = ChatParticipant.objects.filter(
+            user=request.user, chat__active=True
+        ).values_list("chat_id", flat=True)
+
+        # Optionally restrict to a comma separated list of chat ids
+        requested = request.query_params.get("chat_ids")
+        if requested:
+            try:
+                requested = [int(chat_id) for chat_id in requested.split(",")]
+            except ValueError:
+                return Response(
+                    {"detail": "chat_ids must be a comma separated list of ids."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            chat_ids = chat_ids.filter(chat_id__in=requested)
+
+        online = async_to_sync(get_presence().online_users)(sorted(chat_ids))
+
+        return Response(
+            {
+                "chats": [
+                    {"chat_id": chat_id, "online_user_ids": user_ids}
+                    for chat_id, user_ids in online.items()
+                ]
+            }
+        )
+
     def notify_new_chat(self, chat_id, user_id):
         """Notify a user about a new chat via WebSocket"""
         channel_layer = get_channel_layer()
@@ -168,13 +213,16 @@ class ChatViewSet(viewsets.ModelViewSet):
             chat = Chat.objects.get(id=chat_id)
             chat_data = ChatSerializer(chat).data
 
-            async_to_sync(channel_layer.group_send)(
+            async_to_sync(group_send)(
+                channel_layer,
                 f"user_{user_id}",
-                {
-                    "type": "chat.event",
-                    "event": "nuevo_chat",
-                    "chat": chat_data,
-                },
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "nuevo_chat",
+                        "chat": chat_data,
+                    }
+                ),
             )
         except Exception as e:
             print(f"WebSocket notification error: {e}")
@@ -184,61 +232,27 @@ class ChatViewSet(viewsets.ModelViewSet):
         channel_layer = get_channel_layer()
 
         try:
-            async_to_sync(channel_layer.group_send)(
+            async_to_sync(group_send)(
+                channel_layer,
                 f"chat_{chat_id}",
-                {
-                    "type": "chat.event",
-                    "event": "participantes_actualizados",
-                    "participants": participants_data,
-                },
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "participantes_actualizados",
+                        "chat_id": chat_id,
+                        "participants": participants_data,
+                    }
+                ),
             )
         except Exception as e:
             print(f"WebSocket notification error: {e}")
 
     def mark_messages_as_delivered(self, chat_id, user):
         """Mark unread messages as delivered"""
-        unread_statuses = MessageStatus.objects.filter(
-            message__chat_id=chat_id, receiver=user, status="sent"
-        )
-
-        for status in unread_statuses:
-            status.status = "delivered"
-            status.save()
-
-            # Notify the sender about message being delivered
-            self.notify_message_status_change(status)
-
-    def notify_message_status_change(self, message_status):
-        """Notify about message status changes"""
-        channel_layer = get_channel_layer()
-
-        try:
-            # Notify the chat room
-            async_to_sync(channel_layer.group_send)(
-                f"chat_{message_status.message.chat.id}",
-                {
-                    "type": "chat.event",
-                    "event": "mensaje_estado",
-                    "message_id": message_status.message.id,
-                    "user_id": message_status.receiver.id,
-                    "status": message_status.status,
-                },
-            )
+        changes = mark_chat_messages(chat_id, user, "delivered")
 
-            # Notify the message sender specifically
-            async_to_sync(channel_layer.group_send)(
-                f"user_{message_status.message.sender.id}",
-                {
-                    "type": "chat.event",
-                    "event": "mensaje_estado",
-                    "message_id": message_status.message.id,
-                    "chat_id": message_status.message.chat.id,
-                    "user_id": message_status.receiver.id,
-                    "status": message_status.status,
-                },
-            )
-        except Exception as e:
-            print(f"WebSocket notification error: {e}")
+        # Notify the senders about their messages being delivered
+        notify_message_status_batch(chat_id, user.id, "delivered", changes)
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -256,7 +270,7 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         if chat_id:
             # Check if user is a participant in this chat
-            if not ChatParticipant.objects.filter(chat_id=chat_id, user=user).exists():
+            if not is_member(chat_id, user.id):
                 return Message.objects.none()
 
             messages = Message.objects.filter(chat_id=chat_id)
@@ -265,7 +279,7 @@ class MessageViewSet(viewsets.ModelViewSet):
             return (
                 messages.select_related("sender")
                 .prefetch_related("receiver_statuses", "receiver_statuses__receiver")
-                .order_by("-sent_at")
+                .order_by("-seq")
             )
 
         # Return messages from all chats where user is a participant
@@ -275,6 +289,12 @@ class MessageViewSet(viewsets.ModelViewSet):
             .order_by("-sent_at")
         )
 
+    def perform_destroy(self, instance):
+        """Delete a message and recompute its chat's last message fields"""
+        with transaction.atomic():
+            instance.delete()
+            Chat.refresh_activity(instance.chat_id)
+
     def create(self, request, *args, **kwargs):
         """Create a message following the sequence diagram flow"""
         # Extract the chat ID from either the URL or request data
@@ -289,29 +309,21 @@ class MessageViewSet(viewsets.ModelViewSet):
 
         # Check if user is a participant
         user = request.user
-        if not ChatParticipant.objects.filter(chat_id=chat_id, user=user).exists():
+        if not is_member(chat_id, user.id):
             return Response(
                 {"detail": "You are not a participant in this chat."},
                 status=status.HTTP_403_FORBIDDEN,
             )
 
-        # Create the message in database
-        chat = Chat.objects.get(id=chat_id)
-        message = Message.objects.create(chat=chat, sender=user, content=content)
-
-        # Create message status entries for all participants except sender
-        participants = ChatParticipant.objects.filter(chat=chat).exclude(user=user)
-        for participant in participants:
-            MessageStatus.objects.create(
-                message=message, receiver=participant.user, status="sent"
-            )
+        # Create the message and its receipts in one transaction
+        message = create_message(chat_id, user, content)
 
         # Serialize and return the created message
         serializer = self.get_serializer(message)
 
         # Notify participants via WebSocket - this matches the sequence diagram's
         # "par" section showing REST API and WebSocket in parallel
-        self.notify_new_message(message)
+        self.notify_new_message(message, serializer.data)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -341,47 +353,33 @@ class MessageViewSet(viewsets.ModelViewSet):
             )
 
         # Check if user is a participant
-        if not ChatParticipant.objects.filter(
-            chat_id=chat_id, user=request.user
-        ).exists():
+        if not is_member(chat_id, request.user.id):
             return Response(
                 {"detail": "You are not a participant in this chat."},
                 status=status.HTTP_403_FORBIDDEN,
             )
 
         # Update status for all unread messages
-        statuses = MessageStatus.objects.filter(
-            message__chat_id=chat_id,
-            receiver=request.user,
-            status__in=["sent", "delivered"],
-        )
-
-        updated_count = 0
-        for status_obj in statuses:
-            status_obj.status = "read"
-            status_obj.save()
-            updated_count += 1
+        changes = mark_chat_messages(chat_id, request.user, "read")
+        updated_count = len(changes)
 
-            # Notify about status change
-            try:
-                # When tasks module is implemented
-                from .tasks import notify_message_status_change
-
-                notify_message_status_change(status_obj.id)
-            except ImportError:
-                pass
+        # Notify about status change
+        notify_message_status_batch(chat_id, request.user.id, "read", changes)
 
         # Notify via WebSocket
         try:
             channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
+            async_to_sync(group_send)(
+                channel_layer,
                 f"chat_{chat_id}",
-                {
-                    "type": "chat.event",
-                    "event": "mensajes_leidos",
-                    "user_id": request.user.id,
-                    "chat_id": int(chat_id),
-                },
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "mensajes_leidos",
+                        "user_id": request.user.id,
+                        "chat_id": int(chat_id),
+                    }
+                ),
             )
         except Exception as e:
             print(f"WebSocket notification error: {e}")
@@ -412,33 +410,55 @@ class MessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        if uses_watermarks():
+            # Cursors only move forward, a receipt cannot go back to sent
+            if new_status not in ("delivered", "read"):
+                return Response(
+                    {"detail": "Status can only move to delivered or read."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            # Advance the cursors up to this message and report the result
+            changes = mark_chat_messages(
+                message.chat_id, request.user, new_status, up_to=message.id
+            )
+            notify_message_status_batch(
+                message.chat_id, request.user.id, new_status, changes
+            )
+            receipt = next(
+                (
+                    receipt
+                    for receipt in MessageSerializer(message).data["statuses"]
+                    if receipt["receiver"]["id"] == request.user.id
+                ),
+                None,
+            )
+            return Response(receipt, status=status.HTTP_200_OK)
+
         # Update or create status
         status_obj, created = MessageStatus.objects.update_or_create(
             message=message, receiver=request.user, defaults={"status": new_status}
         )
 
         # Notify about status change
-        from .tasks import notify_message_status_change
-
-        notify_message_status_change(status_obj.id)
+        notify_message_status_change(message, request.user.id, new_status)
 
         return Response(
             MessageStatusSerializer(status_obj).data, status=status.HTTP_200_OK
         )
 
-    def notify_new_message(self, message):
+    def notify_new_message(self, message, message_data=None):
         """Notify participants about a new message via WebSocket"""
         channel_layer = get_channel_layer()
-        message_data = MessageSerializer(message).data
+        if message_data is None:
+            message_data = MessageSerializer(message).data
 
         try:
             # Broadcast to the chat room
-            async_to_sync(channel_layer.group_send)(
-                f"chat_{message.chat.id}",
-                {
-                    "type": "chat.message",
-                    "message": message_data,
-                },
+            async_to_sync(group_send)(
+                channel_layer,
+                f"chat_{message.chat_id}",
+                message_event(message, message_data),
             )
         except Exception as e:
             print(f"WebSocket notification error: {e}")
@@ -0,0 +1,109 @@
+"""Helpers shared by the benchmark management commands"""
+
+import json
+import math
+import threading
+import time
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples_ms):
+    """Latency summary in milliseconds for a list of samples"""
+    if not samples_ms:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    return {
+        "count": len(samples_ms),
+        "mean": round(sum(samples_ms) / len(samples_ms), 3),
+        "p50": round(percentile(samples_ms, 50), 3),
+        "p95": round(percentile(samples_ms, 95), 3),
+        "p99": round(percentile(samples_ms, 99), 3),
+        "max": round(max(samples_ms), 3),
+    }
+
+
+def write_report(command, results, as_json, output=None):
+    """Print a benchmark report as JSON or a plain table, optionally to a file"""
+    if as_json or output:
+        payload = json.dumps(results, indent=2, default=str)
+        if output:
+            with open(output, "w") as fh:
+                fh.write(payload + "\n")
+        if as_json:
+            command.stdout.write(payload)
+            return
+
+    for row in results.get("rows", []):
+        command.stdout.write("  ".join(f"{key}={value}" for key, value in row.items()))
+
+
+class QueryCounter:
+    """
+    Counts queries and their time on every database connection, whichever
+    thread runs them, while ``active`` is set.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.active = False
+        self._lock = threading.Lock()
+
+    def install(self):
+        """Wrap the current thread's connections and every new one"""
+        connection_created.connect(self._wrap, weak=False)
+        for connection in connections.all(initialized_only=True):
+            self._wrap(connection=connection)
+
+    def _wrap(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def reset(self):
+        with self._lock:
+            self.queries = 0
+            self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.active:
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.queries += 1
+                self.seconds += elapsed
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB, when the platform tells"""
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return round(pages * resource.getpagesize() / 2**20, 1)
+    except (OSError, AttributeError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, when the platform tells"""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
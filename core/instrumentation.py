@@ -0,0 +1,121 @@
+"""
+Per-request and per-event database accounting.
+
+Every query run inside ``database_scope()`` is counted and timed into the
+scope, including queries run by ``sync_to_async`` threads, which share the
+caller's context. ``report_database_use`` logs the worst query shapes of
+a scope that went over ``SLOW_DB_TIME_MS`` or ``SLOW_DB_QUERIES``, which is
+how N+1 patterns show up in production logs.
+"""
+
+import contextvars
+import logging
+import re
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+# Statements kept per scope for the slow report
+MAX_STATEMENTS = 1000
+
+# Runs of placeholders, e.g. the contents of IN (...)
+PLACEHOLDER_RUN = re.compile(r"%s(?:\s*,\s*%s)+")
+
+_database_scope = contextvars.ContextVar("database_scope", default=None)
+
+
+class DatabaseScope:
+    __slots__ = ("queries", "seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        # (sql, seconds) of the first MAX_STATEMENTS queries
+        self.statements = []
+
+
+def _time_query(execute, sql, params, many, context):
+    scope = _database_scope.get()
+    if scope is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        scope.queries += 1
+        scope.seconds += elapsed
+        if len(scope.statements) < MAX_STATEMENTS:
+            scope.statements.append((sql, elapsed))
+
+
+def _wrap_connection(sender=None, connection=None, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def track_database():
+    """Time queries on every database connection inside ``database_scope``"""
+    connection_created.connect(_wrap_connection, dispatch_uid="core.instrumentation")
+    for connection in connections.all(initialized_only=True):
+        _wrap_connection(connection=connection)
+
+
+@contextmanager
+def database_scope():
+    """Collect the queries run until exit into the yielded DatabaseScope"""
+    scope = DatabaseScope()
+    token = _database_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _database_scope.reset(token)
+
+
+def sql_shape(sql):
+    """Statement with runs of placeholders collapsed, to group repeats"""
+    return PLACEHOLDER_RUN.sub("%s, ...", " ".join(sql.split()))
+
+
+def is_slow(scope):
+    time_limit = getattr(settings, "SLOW_DB_TIME_MS", 0)
+    query_limit = getattr(settings, "SLOW_DB_QUERIES", 0)
+    return (time_limit and scope.seconds * 1000 >= time_limit) or (
+        query_limit and scope.queries >= query_limit
+    )
+
+
+def report_database_use(label, scope, worst=5):
+    """Log the costliest query shapes of a scope over the slow limits"""
+    if not is_slow(scope):
+        return
+
+    shapes = {}
+    for sql, seconds in scope.statements:
+        entry = shapes.setdefault(sql_shape(sql), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    ranked = sorted(shapes.items(), key=lambda item: item[1][1], reverse=True)
+    logger.warning(
+        "Slow database use in %s: %d queries, %.1f ms%s",
+        label,
+        scope.queries,
+        scope.seconds * 1000,
+        "".join(
+            f"\n  {count}x {seconds * 1000:.1f} ms: {shape[:500]}"
+            for shape, (count, seconds) in ranked[:worst]
+        ),
+    )
+
+
+def server_timing(scope, total_seconds):
+    """``Server-Timing`` header value for a request"""
+    return (
+        f'db;dur={scope.seconds * 1000:.1f};desc="{scope.queries} queries", '
+        f"total;dur={total_seconds * 1000:.1f}"
+    )
@@ -0,0 +1,172 @@
+"""
+In-process metrics exposed in the Prometheus text format.
+
+Recording a value is a couple of dict and float operations, without locks,
+so it can sit on the message hot path. Values that are cheap to read but
+costly to keep current (queue depths, handshake stats) are gathered by
+collectors when the endpoint is scraped. Every server process keeps its own
+values: scrape each process and aggregate in Prometheus.
+"""
+
+import bisect
+
+# Seconds, from a fast cache hit to a slow broadcast
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+METRICS = []
+COLLECTORS = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def metric_lines(name, kind, help, samples):
+    """Exposition lines for ``samples``, a list of ``(labels, value)``"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        rendered = _labels(labels.keys(), labels.values())
+        lines.append(f"{name}{rendered} {_number(value)}")
+    return lines
+
+
+class Counter:
+    """Monotonic count, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in list(self.values.items()):
+            rendered = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}{rendered} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """Value that goes up and down"""
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per bucket counts (+Inf last), sum]
+        self.values = {}
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                rendered = _labels(self.labelnames, labels, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{rendered} {cumulative}")
+            rendered = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{rendered} {_number(total)}")
+            lines.append(f"{self.name}_count{rendered} {cumulative}")
+        return lines
+
+
+def register_collector(collector):
+    """Add a callable returning exposition lines, run on every scrape"""
+    COLLECTORS.append(collector)
+    return collector
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collector in COLLECTORS:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+    return "\n".join(lines) + "\n"
+
+
+WS_CONNECTIONS = Gauge(
+    "besage_ws_connections", "Open WebSocket connections", ["consumer"]
+)
+WS_FRAMES_RECEIVED = Counter(
+    "besage_ws_frames_received_total", "Frames received from clients", ["type"]
+)
+WS_EVICTIONS = Counter(
+    "besage_ws_evictions_total", "Sockets closed for falling too far behind"
+)
+WS_EVENT_DB_SECONDS = Histogram(
+    "besage_ws_event_db_seconds",
+    "Database time spent per WebSocket event or client frame type",
+    ["type"],
+)
+GROUP_SEND_SECONDS = Histogram(
+    "besage_group_send_seconds", "Channel layer group_send latency"
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "besage_http_request_seconds", "REST request duration", ["view"]
+)
+HTTP_DB_SECONDS = Histogram(
+    "besage_http_db_seconds", "Database time spent per REST request", ["view"]
+)
+TASK_LAG_SECONDS = Histogram(
+    "besage_task_lag_seconds", "Time tasks wait in the queue before running"
+)
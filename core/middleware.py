@@ -0,0 +1,35 @@
+import time
+from django.conf import settings
+from .instrumentation import database_scope, report_database_use, server_timing
+from .metrics import HTTP_DB_SECONDS, HTTP_REQUEST_SECONDS
+
+
+class MetricsMiddleware:
+    """
+    Account the duration, queries and database time of each request.
+
+    Records them by view name in the metrics, reports requests over the
+    slow database limits and, with ``SERVER_TIMING`` on, adds a
+    ``Server-Timing`` header to the response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with database_scope() as db:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unresolved"
+        HTTP_REQUEST_SECONDS.observe(elapsed, view)
+        HTTP_DB_SECONDS.observe(db.seconds, view)
+        report_database_use(f"{request.method} {request.path} ({view})", db)
+
+        if getattr(settings, "SERVER_TIMING", False):
+            timing = server_timing(db, elapsed)
+            existing = response.get("Server-Timing")
+            response["Server-Timing"] = f"{existing}, {timing}" if existing else timing
+        return response
@@ -76,24 +76,139 @@ REST_FRAMEWORK = {
 # Channels settings
 ASGI_APPLICATION = "core.asgi.application"
 # Channel Layers configuration
+# CHANNEL_LAYER_FANOUT sends each group message once per node, which then
+# delivers it to its own sockets. All processes must use the same setting.
+CHANNEL_LAYER_FANOUT = os.environ.get("CHANNEL_LAYER_FANOUT", "False").lower() == "true"
 if os.environ.get("REDIS_URL"):
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "BACKEND": (
+                "socket_handlers.layers.NodeFanoutChannelLayer"
+                if CHANNEL_LAYER_FANOUT
+                else "channels_redis.core.RedisChannelLayer"
+            ),
             "CONFIG": {
                 "hosts": [os.environ.get("REDIS_URL")],
             },
         },
     }
 else:
-    # Use in-memory channel layer for development
+    # In-process channel layer for development and single-process nodes
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "BACKEND": "socket_handlers.layers.LocalChannelLayer",
         },
     }
 
+# Requests and WebSocket events using the database for at least
+# SLOW_DB_TIME_MS, or running at least SLOW_DB_QUERIES queries, are logged
+# with their costliest statements (0 disables a limit). SERVER_TIMING adds
+# database time and query counts to REST responses, by default only in DEBUG.
+SLOW_DB_TIME_MS = float(os.environ.get("SLOW_DB_TIME_MS", "200"))
+SLOW_DB_QUERIES = int(os.environ.get("SLOW_DB_QUERIES", "50"))
+SERVER_TIMING = os.environ.get("SERVER_TIMING", str(DEBUG)).lower() == "true"
+
+# Bearer token required to scrape /api/metrics/; open when empty
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Background tasks (status notifications). Tasks queued within the batch
+# window are handled together; failures are retried with backoff.
+TASK_QUEUE_OPTIONS = {
+    "batch_window": float(os.environ.get("TASK_BATCH_WINDOW_MS", "10")) / 1000,
+    "max_retries": int(os.environ.get("TASK_MAX_RETRIES", "3")),
+}
+if os.environ.get("REDIS_URL"):
+    TASK_QUEUE = {
+        "BACKEND": "core.tasks.RedisTaskQueue",
+        "CONFIG": {"url": os.environ.get("REDIS_URL"), **TASK_QUEUE_OPTIONS},
+    }
+else:
+    TASK_QUEUE = {
+        "BACKEND": "core.tasks.InProcessTaskQueue",
+        "CONFIG": TASK_QUEUE_OPTIONS,
+    }
+
+# Cache shared by all workers, used for chat membership lookups
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Chat member sets: seconds kept in the shared cache and in each process
+MEMBERSHIP_CACHE_TTL = int(os.environ.get("MEMBERSHIP_CACHE_TTL", "300"))
+MEMBERSHIP_LOCAL_TTL = float(os.environ.get("MEMBERSHIP_LOCAL_TTL", "5"))
+
+# Read receipts storage: "status" keeps one MessageStatus row per recipient,
+# "watermark" keeps last delivered/read cursors on each ChatParticipant
+CHAT_RECEIPT_MODE = os.environ.get("CHAT_RECEIPT_MODE", "status")
+
+# Typing indicators: seconds without typing frames before a stop is sent,
+# and minimum seconds between repeated typing broadcasts per user and chat
+TYPING_TTL = float(os.environ.get("TYPING_TTL", "5"))
+TYPING_REFRESH = float(os.environ.get("TYPING_REFRESH", "3"))
+
+# Presence registry: who is online in each chat, kept alive by heartbeats
+if os.environ.get("REDIS_URL"):
+    PRESENCE = {
+        "BACKEND": "socket_handlers.presence.RedisPresence",
+        "CONFIG": {"url": os.environ.get("REDIS_URL"), "ttl": 60},
+    }
+else:
+    PRESENCE = {
+        "BACKEND": "socket_handlers.presence.InMemoryPresence",
+        "CONFIG": {"ttl": 60},
+    }
+# Seconds between presence heartbeats sent by each open WebSocket
+PRESENCE_HEARTBEAT = float(os.environ.get("PRESENCE_HEARTBEAT", "20"))
+
+# Users resolved during WebSocket handshakes are cached per process
+WS_USER_CACHE_SIZE = int(os.environ.get("WS_USER_CACHE_SIZE", "10000"))
+WS_USER_CACHE_TTL = float(os.environ.get("WS_USER_CACHE_TTL", "60"))
+
+# Window, in milliseconds, during which events for a socket that negotiated
+# a "+batch" subprotocol are collected into one array frame
+WS_BATCH_WINDOW_MS = float(os.environ.get("WS_BATCH_WINDOW_MS", "5"))
+
+# Outgoing events queued per socket. Ephemeral events (typing, presence) are
+# capped separately and shed first; a socket that stays above the high-water
+# mark for the grace period, or reaches twice it, is closed so it resyncs.
+WS_OUTBOX_HIGH_WATER = int(os.environ.get("WS_OUTBOX_HIGH_WATER", "500"))
+WS_OUTBOX_GRACE = float(os.environ.get("WS_OUTBOX_GRACE", "10"))
+WS_EPHEMERAL_LIMIT = int(os.environ.get("WS_EPHEMERAL_LIMIT", "100"))
+
+# Messages replayed to a reconnecting socket per frame, and in total, before
+# the client is told to fall back to the REST history
+WS_REPLAY_PAGE_SIZE = int(os.environ.get("WS_REPLAY_PAGE_SIZE", "100"))
+WS_REPLAY_LIMIT = int(os.environ.get("WS_REPLAY_LIMIT", "1000"))
+
+# Threads running the database work of WebSocket consumers. Each thread holds
+# its own connection; 0 falls back to Channels' single shared DB thread.
+WS_DB_EXECUTOR_WORKERS = int(os.environ.get("WS_DB_EXECUTOR_WORKERS", "8"))
+
+# Write-behind mode: socket messages are broadcast before they are stored and
+# written in batches every WRITE_BEHIND_INTERVAL_MS or WRITE_BEHIND_BATCH_SIZE
+# rows. Message ids are then generated by the application; each process
+# leases its own id node (up to 32 processes) from the shared cache.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "False").lower() == "true"
+WRITE_BEHIND_INTERVAL_MS = float(os.environ.get("WRITE_BEHIND_INTERVAL_MS", "10"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "100"))
+# Seconds a reserved seq holds replays back while its message is not stored,
+# bounding the wait on messages lost with their process
+WRITE_BEHIND_PENDING_TTL = int(os.environ.get("WRITE_BEHIND_PENDING_TTL", "30"))
+# Worker processes per server, as read by gunicorn
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
 MIDDLEWARE = [
+    "core.middleware.MetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -0,0 +1,397 @@
+"""
+Background task queue for work callers should not wait on.
+
+Tasks are registered by name with an async handler that receives every
+payload queued for that name since the last run, so handlers can merge and
+dedupe them. Two backends are available:
+
+- ``InProcessTaskQueue`` runs handlers on the server's event loop. Tasks
+  still queued when the process stops are lost.
+- ``RedisTaskQueue`` stores tasks in a Redis list shared by all workers and
+  delivers them at least once, including across worker crashes.
+
+When a merged batch fails its payloads are run again one at a time, and
+the ones failing on their own are retried with exponential backoff up to
+``max_retries`` times, so handlers may see a payload more than once.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+import weakref
+from asgiref.sync import SyncToAsync, async_to_sync
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .metrics import TASK_LAG_SECONDS, metric_lines, register_collector
+
+logger = logging.getLogger(__name__)
+
+TASK_HANDLERS = {}
+
+
+def register_task(name):
+    """Register an async handler taking the list of payloads queued for it"""
+
+    def decorator(handler):
+        TASK_HANDLERS[name] = handler
+        return handler
+
+    return decorator
+
+
+def server_event_loop():
+    """
+    The event loop serving the current request, if any.
+
+    Sync code run through ``sync_to_async`` (views, consumer database calls)
+    learns about it from asgiref's thread local.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    loop = getattr(SyncToAsync.threadlocal, "main_event_loop", None)
+    if loop is not None and loop.is_running() and not loop.is_closed():
+        return loop
+    return None
+
+
+class BaseTaskQueue:
+    def __init__(self, batch_window=0.01, max_retries=3, retry_delay=0.5):
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        # Worker task per event loop
+        self._workers = weakref.WeakKeyDictionary()
+
+    def enqueue(self, name, payload):
+        """Queue a task from sync or async code without waiting for it"""
+        raise NotImplementedError
+
+    def depth(self):
+        """Number of tasks waiting to run"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+    def start(self):
+        """Called by consumers on connect, from the server's event loop"""
+
+    def ensure_worker(self, loop):
+        """Start the worker on ``loop`` unless it is already running there"""
+        worker = self._workers.get(loop)
+        if worker is None or worker.done():
+            self._workers[loop] = loop.create_task(self.work())
+
+    async def work(self):
+        raise NotImplementedError
+
+    async def process(self, items):
+        """Run handlers for ``(name, payload, attempt, queued_at)`` items"""
+        now = time.time()
+        by_name = {}
+        for name, payload, attempt, queued_at in items:
+            by_name.setdefault(name, []).append((payload, attempt, queued_at))
+            TASK_LAG_SECONDS.observe(max(now - queued_at, 0))
+
+        for name, entries in by_name.items():
+            handler = TASK_HANDLERS.get(name)
+            if handler is None:
+                logger.error("No task handler for %s", name)
+                self.failed += len(entries)
+                continue
+            await self.run(name, handler, entries)
+
+    async def run(self, name, handler, entries):
+        """Run a handler on merged entries, isolating the ones that fail"""
+        try:
+            await handler([payload for payload, _, _ in entries])
+            self.processed += len(entries)
+            return
+        except Exception:
+            if len(entries) > 1:
+                # One bad payload must not spend the retries of the others
+                logger.warning(
+                    "Task %s failed on %d payloads, running them one by one",
+                    name,
+                    len(entries),
+                    exc_info=True,
+                )
+                for entry in entries:
+                    await self.run(name, handler, [entry])
+                return
+            logger.exception("Task %s failed", name)
+
+        [(payload, attempt, queued_at)] = entries
+        attempt += 1
+        if attempt > self.max_retries:
+            self.failed += 1
+            return
+        self.retried += 1
+        await self.retry(
+            [(name, payload, attempt, queued_at)],
+            self.retry_delay * 2 ** (attempt - 1),
+        )
+
+    async def retry(self, items, delay):
+        raise NotImplementedError
+
+
+class InProcessTaskQueue(BaseTaskQueue):
+    """Queue living in the worker process, handled on its event loop"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.items = []
+
+    def enqueue(self, name, payload):
+        item = (name, payload, 0, time.time())
+        loop = server_event_loop()
+        if loop is None:
+            # No server loop to hand it to (shell, management commands)
+            async_to_sync(self.process)([item])
+            return
+        self._put_threadsafe(loop, [item])
+
+    def _put_threadsafe(self, loop, items):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._put(loop, items)
+        else:
+            loop.call_soon_threadsafe(self._put, loop, items)
+
+    def _put(self, loop, items):
+        self.items.extend(items)
+        self.ensure_worker(loop)
+
+    def depth(self):
+        return len(self.items)
+
+    async def work(self):
+        while self.items:
+            # Let related tasks pile up so they are handled together
+            await asyncio.sleep(self.batch_window)
+            items, self.items = self.items, []
+            await self.process(items)
+
+    async def retry(self, items, delay):
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay, self._put, loop, items)
+
+
+# Move up to ARGV[1] tasks from the queue to a worker's processing list
+TAKE_SCRIPT = """
+local taken = {}
+for i=1,tonumber(ARGV[1]) do
+    local item = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not item then
+        break
+    end
+    taken[#taken + 1] = item
+end
+return taken
+"""
+
+# Move retries due by ARGV[1] back to the queue, at most ARGV[2] of them,
+# and return when the next one is due
+REQUEUE_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+    redis.call('RPUSH', KEYS[2], unpack(due))
+end
+local next = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return next[2]
+"""
+
+
+class RedisTaskQueue(BaseTaskQueue):
+    """
+    Queue stored in a Redis list so any worker process can handle it.
+
+    Workers move the tasks they take to their own processing list and
+    delete it once the batch was handled, so tasks outlive a worker crash:
+    the lists of workers whose heartbeat expired for ``worker_timeout``
+    seconds are moved back to the queue. Retries wait in a sorted set
+    scored by due time. Needs Redis 6.2 or later.
+    """
+
+    key = "tasks:queue"
+
+    def __init__(
+        self, url, batch_size=500, worker_timeout=60, recover_interval=15, **options
+    ):
+        super().__init__(**options)
+        self.url = url
+        self.batch_size = batch_size
+        self.worker_timeout = worker_timeout
+        self.recover_interval = recover_interval
+        self._sync_client = None
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def delayed_key(self):
+        return f"{self.key}:delayed"
+
+    @property
+    def workers_key(self):
+        return f"{self.key}:workers"
+
+    def _heartbeat_key(self, worker):
+        return f"{self.key}:heartbeat:{worker}"
+
+    def _processing_key(self, worker):
+        return f"{self.key}:processing:{worker}"
+
+    def _client(self):
+        import redis
+
+        if self._sync_client is None:
+            self._sync_client = redis.Redis.from_url(self.url)
+        return self._sync_client
+
+    def _async_client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = redis.asyncio.from_url(self.url)
+            self._clients[loop] = client
+        return client
+
+    def enqueue(self, name, payload):
+        self._client().rpush(self.key, json.dumps([name, payload, 0, time.time()]))
+        loop = server_event_loop()
+        if loop is not None:
+            loop.call_soon_threadsafe(self.ensure_worker, loop)
+
+    def depth(self):
+        pipe = self._client().pipeline(transaction=False)
+        pipe.llen(self.key)
+        pipe.zcard(self.delayed_key)
+        return sum(pipe.execute())
+
+    def start(self):
+        # Every server process helps draining the shared list
+        self.ensure_worker(asyncio.get_running_loop())
+
+    async def heartbeat(self, client, worker):
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.sadd(self.workers_key, worker)
+            pipe.set(self._heartbeat_key(worker), 1, ex=self.worker_timeout)
+            await pipe.execute()
+
+    async def recover(self, client):
+        """Requeue the tasks held by workers whose heartbeat expired"""
+        for worker in await client.smembers(self.workers_key):
+            worker = worker.decode()
+            if await client.exists(self._heartbeat_key(worker)):
+                continue
+            # One task per atomic move, so concurrent recoveries lose nothing
+            processing = self._processing_key(worker)
+            while await client.lmove(processing, self.key, "RIGHT", "LEFT"):
+                pass
+            await client.srem(self.workers_key, worker)
+
+    async def work(self):
+        client = self._async_client()
+        worker = uuid.uuid4().hex
+        processing = self._processing_key(worker)
+        next_beat = 0
+        while True:
+            try:
+                if time.monotonic() >= next_beat:
+                    await self.heartbeat(client, worker)
+                    await self.recover(client)
+                    next_beat = time.monotonic() + self.recover_interval
+
+                now = time.time()
+                next_due = await client.eval(
+                    REQUEUE_DUE_SCRIPT,
+                    2,
+                    self.delayed_key,
+                    self.key,
+                    now,
+                    self.batch_size,
+                )
+                # Wake up in time for the next retry
+                timeout = 1
+                if next_due is not None:
+                    timeout = min(max(float(next_due) - now, 0.01), timeout)
+                first = await client.blmove(
+                    self.key, processing, timeout, "LEFT", "RIGHT"
+                )
+                if first is None:
+                    continue
+
+                await asyncio.sleep(self.batch_window)
+                rest = await client.eval(
+                    TAKE_SCRIPT, 2, self.key, processing, self.batch_size - 1
+                )
+
+                items = [tuple(json.loads(raw)) for raw in [first, *rest]]
+                await self.process(items)
+                # Handled, given up on or scheduled for retry
+                await client.delete(processing)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Task queue worker error")
+                await asyncio.sleep(1)
+
+    async def retry(self, items, delay):
+        # Identical tasks collapse into one member, which handlers would
+        # merge anyway
+        due = time.time() + delay
+        await self._async_client().zadd(
+            self.delayed_key, {json.dumps(list(item)): due for item in items}
+        )
+
+
+_task_queue = None
+
+
+@register_collector
+def task_queue_metrics():
+    if _task_queue is None:
+        return []
+    stats = _task_queue.stats()
+    return metric_lines(
+        "besage_task_queue_depth",
+        "gauge",
+        "Tasks waiting to run",
+        [({}, stats["depth"])],
+    ) + metric_lines(
+        "besage_tasks_total",
+        "counter",
+        "Tasks handled by this process, by outcome",
+        [
+            ({"outcome": outcome}, stats[outcome])
+            for outcome in ("processed", "retried", "failed")
+        ],
+    )
+
+
+def get_task_queue():
+    """Return the configured task queue, creating it on first use"""
+    global _task_queue
+    if _task_queue is None:
+        config = getattr(settings, "TASK_QUEUE", {})
+        backend = import_string(config.get("BACKEND", "core.tasks.InProcessTaskQueue"))
+        _task_queue = backend(**config.get("CONFIG", {}))
+    return _task_queue
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
@@ -12,6 +13,7 @@ from django.views.decorators.csrf import csrf_exempt
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
+from core.metrics import render as render_metrics
 
 
 @csrf_exempt
@@ -38,6 +40,21 @@ def health_check(request):
         )
 
 
+@csrf_exempt
+def metrics(request):
+    """Prometheus metrics of the server process handling the request"""
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if not token:
+        # Open only on development servers
+        if not settings.DEBUG:
+            return HttpResponse(status=404)
+    elif request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Besage Chat API",
@@ -64,6 +81,7 @@ urlpatterns = [
     path("api/auth/logout/", LogoutView.as_view(), name="logout"),
     path("api/auth/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("api/health/", health_check, name="health_check"),
+    path("api/metrics/", metrics, name="metrics"),
     path("api/", include(router.urls)),
     path(
         "swagger<format>/", schema_view.without_ui(cache_timeout=0), name="schema-json"
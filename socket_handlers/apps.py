@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SocketHandlersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "socket_handlers"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,10 +1,603 @@
-import json
+import asyncio
+import time
+import weakref
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from chat.models import Chat, Message, ChatParticipant, MessageStatus
+from chat.membership import cached_members, is_member
+from chat.receipts import mark_chat_messages
+from chat.replay import missed_messages, missed_receipts, seq_for_message
+from chat.services import (
+    create_message,
+    message_event,
+    prepare_message,
+    unstored_seqs,
+    uses_write_behind,
+)
+from chat.tasks import notify_message_status_batch
+from core.instrumentation import database_scope, report_database_use
+from core.metrics import (
+    WS_CONNECTIONS,
+    WS_EVENT_DB_SECONDS,
+    WS_EVICTIONS,
+    WS_FRAMES_RECEIVED,
+    metric_lines,
+    register_collector,
+)
+from core.tasks import get_task_queue
+from .db import db_sync_to_async
+from .layers import group_send
+from .presence import get_presence
+from .protocol import RESYNC_CLOSE_CODE, broadcast, negotiate
+from .typing_state import TypingState
+from .write_behind import get_message_writer
+
+
+# Frame types counted by name in metrics; anything else counts as "other"
+FRAME_TYPES = {
+    "chat_message",
+    "typing",
+    "presence_query",
+    "read_messages",
+    "delivered_messages",
+    "subscribe",
+    "unsubscribe",
+}
+
+# Open sockets, read when metrics are scraped
+open_sockets = weakref.WeakSet()
+
+
+@register_collector
+def outbox_metrics():
+    depths = [len(socket.outbox) + len(socket.ephemeral) for socket in open_sockets]
+    return metric_lines(
+        "besage_ws_outbox_frames",
+        "gauge",
+        "Frames queued for clients, over all sockets",
+        [({}, sum(depths))],
+    ) + metric_lines(
+        "besage_ws_outbox_frames_max",
+        "gauge",
+        "Most frames queued for a single socket",
+        [({}, max(depths, default=0))],
+    )
+
+
+def parse_cursor(value):
+    """Read a client supplied message id, ignoring anything invalid"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+class EventConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer speaking the codec negotiated at connect time.
+
+    Outgoing events are queued and written by a background task so a slow
+    client never stalls the consumer. The queue has two lanes: chat messages,
+    receipts and replies are kept in order, while ephemeral events (typing,
+    online/offline) are coalesced per chat and user and dropped first under
+    pressure. A socket whose queue stays above ``WS_OUTBOX_HIGH_WATER`` for
+    ``WS_OUTBOX_GRACE`` seconds is closed with ``RESYNC_CLOSE_CODE``.
+
+    Clients that negotiate batching get the events queued during
+    ``WS_BATCH_WINDOW_MS`` sent together as a single array frame.
+    """
+
+    async def websocket_connect(self, message):
+        self.codec, self.subprotocol, batch = negotiate(self.scope.get("subprotocols"))
+        self.batching = batch
+        self.outbox = deque()
+        self.ephemeral = OrderedDict()
+        self.flush_task = None
+        self.over_high_water_since = None
+        self.evicted = False
+        self.counted_as = None
+        open_sockets.add(self)
+        get_task_queue().start()
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, "flush_task", None) is not None:
+            self.flush_task.cancel()
+        if getattr(self, "counted_as", None) is not None:
+            WS_CONNECTIONS.dec(self.counted_as)
+            self.counted_as = None
+        open_sockets.discard(self)
+        await super().websocket_disconnect(message)
+
+    async def dispatch(self, message):
+        """Handle a connection or channel layer event, accounting its queries"""
+        # Client frames relabel themselves with their frame type
+        self.event_label = message["type"]
+        with database_scope() as db:
+            await super().dispatch(message)
+        WS_EVENT_DB_SECONDS.observe(db.seconds, self.event_label)
+        report_database_use(f"WebSocket {self.event_label}", db)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(
+            subprotocol=subprotocol or self.subprotocol, headers=headers
+        )
+        self.counted_as = type(self).__name__
+        WS_CONNECTIONS.inc(self.counted_as)
+
+    async def send_event(self, payload):
+        """Encode an event with the connection's codec and send it"""
+        await self.send_encoded(self.codec.dumps(payload))
+
+    async def send_broadcast(self, event):
+        """Forward a group broadcast in its pre-encoded form"""
+        await self.send_encoded(
+            event["frames"][self.codec.name], coalesce=event.get("coalesce")
+        )
+
+    async def send_encoded(self, data, coalesce=None):
+        """
+        Queue an encoded event for the writer task.
+
+        Events with a ``coalesce`` key go to the ephemeral lane, where they
+        replace any queued event with the same key.
+        """
+        if self.evicted:
+            return
+
+        if coalesce is None:
+            self.outbox.append(data)
+        else:
+            self.ephemeral.pop(coalesce, None)
+            self.ephemeral[coalesce] = data
+            if len(self.ephemeral) > settings.WS_EPHEMERAL_LIMIT:
+                self.ephemeral.popitem(last=False)
+
+        if await self.check_backlog() and self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_outbox())
+
+    async def check_backlog(self):
+        """Shed ephemeral events and evict clients that cannot keep up"""
+        high_water = settings.WS_OUTBOX_HIGH_WATER
+        if len(self.outbox) + len(self.ephemeral) <= high_water:
+            self.over_high_water_since = None
+            return True
+
+        # Typing and presence updates are the first to go
+        self.ephemeral.clear()
+        if len(self.outbox) <= high_water:
+            self.over_high_water_since = None
+            return True
+
+        now = time.monotonic()
+        if self.over_high_water_since is None:
+            self.over_high_water_since = now
+        if (
+            now - self.over_high_water_since < settings.WS_OUTBOX_GRACE
+            and len(self.outbox) < 2 * high_water
+        ):
+            return True
+
+        await self.evict()
+        return False
+
+    async def evict(self):
+        """Drop the backlog and ask the client to reconnect and resync"""
+        self.evicted = True
+        WS_EVICTIONS.inc()
+        self.outbox.clear()
+        self.ephemeral.clear()
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.close(code=RESYNC_CLOSE_CODE)
+
+    def next_frames(self):
+        """Take queued events, durable ones first"""
+        if self.batching:
+            frames = list(self.outbox) + list(self.ephemeral.values())
+            self.outbox.clear()
+            self.ephemeral.clear()
+            return frames
+        if self.outbox:
+            return [self.outbox.popleft()]
+        return [self.ephemeral.popitem(last=False)[1]]
+
+    async def flush_outbox(self):
+        """Write queued events until both lanes are empty"""
+        try:
+            while self.outbox or self.ephemeral:
+                if self.batching:
+                    # Let the batching window fill up before sending
+                    await asyncio.sleep(settings.WS_BATCH_WINDOW_MS / 1000)
+                    frames = self.next_frames()
+                    await self.send(**self.codec.frame(self.codec.join(frames)))
+                else:
+                    await self.send(**self.codec.frame(self.next_frames()[0]))
+        except Exception as e:
+            print(f"WebSocket send error: {e}")
+        finally:
+            self.flush_task = None
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Decode a client frame and hand it to ``receive_event``"""
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+
+        frame_type = data.get("type", "chat_message")
+        if frame_type not in FRAME_TYPES:
+            frame_type = "other"
+        WS_FRAMES_RECEIVED.inc(frame_type)
+        self.event_label = frame_type
+
+        try:
+            await self.receive_event(data)
+        except Exception as e:
+            print(f"Error processing WebSocket message: {e}")
+
+    async def receive_event(self, data):
+        pass
+
+
+class ChatActionsMixin:
+    """Chat frame handling shared by the per-chat and multiplexed consumers"""
+
+    async def handle_chat_frame(self, chat_id, text_data_json):
+        """Process a client frame addressed to a single chat"""
+        chat_id = int(chat_id)
+        chat_group_name = f"chat_{chat_id}"
+        message_type = text_data_json.get("type", "chat_message")
+
+        if message_type == "chat_message":
+            # Handle new chat message
+            content = text_data_json.get("message", "")
+            if not content:
+                return
+
+            if uses_write_behind():
+                await self.post_message_write_behind(
+                    chat_id, content, text_data_json.get("client_id")
+                )
+            else:
+                # Save message to database
+                message_obj = await self.save_message(chat_id, content)
+
+                # Send message to room group
+                await group_send(
+                    self.channel_layer, chat_group_name, message_event(message_obj)
+                )
+
+            # Sending a message ends the typing indicator
+            if self.typing_state.stop(chat_id):
+                await self.notify_typing_stopped(chat_id)
+
+        elif message_type == "typing":
+            # Only typing transitions reach the chat group
+            if text_data_json.get("is_typing", True):
+                if self.typing_state.start(chat_id):
+                    await self.notify_typing(chat_id)
+            elif self.typing_state.stop(chat_id):
+                await self.notify_typing_stopped(chat_id)
+
+        elif message_type == "presence_query":
+            await self.send_presence([chat_id])
+
+        elif message_type == "read_messages":
+            # Mark messages as read
+            if not await self.mark_messages_as_read(chat_id):
+                await self.send_receipt_pending(chat_id)
+
+            # Notify others
+            await group_send(
+                self.channel_layer,
+                chat_group_name,
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "mensajes_leidos",
+                        "user_id": self.user.id,
+                        "chat_id": chat_id,
+                    }
+                ),
+            )
+
+        elif message_type == "delivered_messages":
+            # Mark messages as delivered
+            if not await self.mark_messages_as_delivered(chat_id):
+                await self.send_receipt_pending(chat_id)
+
+            # Notify others
+            await group_send(
+                self.channel_layer,
+                chat_group_name,
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "mensajes_entregados",
+                        "user_id": self.user.id,
+                        "chat_id": chat_id,
+                    }
+                ),
+            )
+
+    async def resume(self, chat_id, params):
+        """
+        Replay a chat from the cursor a reconnecting client supplied.
+
+        ``params`` holds the client's ``last_seq`` or, for clients that only
+        track ids, ``last_message_id``. Nothing happens without either.
+        """
+        last_seq = parse_cursor(params.get("last_seq"))
+        if last_seq is None:
+            last_message_id = parse_cursor(params.get("last_message_id"))
+            if last_message_id is None:
+                return
+            last_seq = await db_sync_to_async(seq_for_message)(chat_id, last_message_id)
+        await self.replay(chat_id, last_seq)
+
+    async def replay(self, chat_id, last_seq):
+        """
+        Stream what the client missed in a chat after sequence ``last_seq``.
+
+        Messages are sent in ``replay`` frames of at most
+        ``WS_REPLAY_PAGE_SIZE`` messages, up to ``WS_REPLAY_LIMIT`` in total,
+        followed by the receipt changes and a ``replay_complete`` frame. When
+        ``truncated`` is set the client should fall back to the REST history.
+        When ``pending`` is set the replay stopped before a message that is
+        not stored yet, and the client should resume again from ``last_seq``.
+        """
+        chat_id = int(chat_id)
+        cursor = last_seq
+        replayed = 0
+        truncated = False
+        held = False
+
+        while True:
+            page_size = min(
+                settings.WS_REPLAY_PAGE_SIZE, settings.WS_REPLAY_LIMIT - replayed
+            )
+            if page_size <= 0:
+                # Only truncated if something is left past the limit
+                rest, held = await db_sync_to_async(missed_messages)(chat_id, cursor, 1)
+                truncated = bool(rest)
+                break
+
+            page, held = await db_sync_to_async(missed_messages)(
+                chat_id, cursor, page_size
+            )
+            if page:
+                cursor = page[-1]["seq"]
+                replayed += len(page)
+                await self.send_event(
+                    {"type": "replay", "chat_id": chat_id, "messages": page}
+                )
+            if held or len(page) < page_size:
+                break
+
+        for event in await db_sync_to_async(missed_receipts)(
+            chat_id, self.user, last_seq
+        ):
+            await self.send_event(event)
+
+        # Live messages already covered by the replay are skipped
+        self.replayed_up_to[chat_id] = cursor
+        await self.send_event(
+            {
+                "type": "replay_complete",
+                "chat_id": chat_id,
+                "last_seq": cursor,
+                "truncated": truncated,
+                "pending": held,
+            }
+        )
+
+    def already_replayed(self, event):
+        """Whether a live message was already sent during a replay"""
+        up_to = self.replayed_up_to.get(event.get("chat_id"))
+        return up_to is not None and event.get("seq", up_to + 1) <= up_to
+
+    async def is_chat_participant(self, chat_id):
+        """Check if current user is a participant in the chat"""
+        members = cached_members(chat_id)
+        if members is not None and self.user.id in members:
+            return True
+        return await db_sync_to_async(is_member)(chat_id, self.user.id)
+
+    @db_sync_to_async
+    def save_message(self, chat_id, content):
+        """Save a new message to the database"""
+        return create_message(chat_id, self.user, content)
+
+    async def post_message_write_behind(self, chat_id, content, client_id=None):
+        """Broadcast a message once its seq is reserved and store it in the
+        next batch"""
+        message = await db_sync_to_async(prepare_message)(chat_id, self.user, content)
+        await group_send(self.channel_layer, f"chat_{chat_id}", message_event(message))
+
+        future = get_message_writer().submit(message)
+        asyncio.ensure_future(self.acknowledge_message(message, future, client_id))
+
+    async def acknowledge_message(self, message, future, client_id):
+        """Tell the sender whether a write-behind message became durable"""
+        frame = {
+            "chat_id": message.chat_id,
+            "message_id": message.id,
+            "seq": message.seq,
+            "client_id": client_id,
+        }
+        try:
+            await future
+        except Exception as e:
+            print(f"Write-behind message error: {e}")
+            # Everyone already saw the message, so withdraw it for them too
+            await group_send(
+                self.channel_layer,
+                f"chat_{message.chat_id}",
+                broadcast(
+                    {
+                        "type": "chat.event",
+                        "event": "message_failed",
+                        "chat_id": message.chat_id,
+                        "message_id": message.id,
+                        "seq": message.seq,
+                    }
+                ),
+            )
+            await self.send_event({"type": "message_failed", **frame})
+            return
+
+        await self.send_event({"type": "message_ack", **frame})
+
+    @db_sync_to_async
+    def mark_messages_as_delivered(self, chat_id):
+        """
+        Mark all messages as delivered for the current user.
+
+        Returns whether the receipt reached every message, which is not the
+        case while write-behind messages of the chat are not stored yet.
+        """
+        changes = mark_chat_messages(chat_id, self.user, "delivered")
+        notify_message_status_batch(chat_id, self.user.id, "delivered", changes)
+        return not uses_write_behind() or not unstored_seqs(chat_id)
+
+    @db_sync_to_async
+    def mark_messages_as_read(self, chat_id):
+        """Mark all messages as read for the current user, like the above"""
+        changes = mark_chat_messages(chat_id, self.user, "read")
+        notify_message_status_batch(chat_id, self.user.id, "read", changes)
+        return not uses_write_behind() or not unstored_seqs(chat_id)
+
+    async def send_receipt_pending(self, chat_id):
+        """Ask the client to repeat a receipt that missed unstored messages"""
+        await self.send_error(
+            chat_id,
+            "Some messages are not stored yet; send the receipt again shortly.",
+        )
+
+    async def send_error(self, chat_id, detail):
+        await self.send_event({"type": "error", "chat_id": chat_id, "detail": detail})
+
+    async def notify_typing(self, chat_id):
+        """Let other users know this user is typing in this chat"""
+        await group_send(
+            self.channel_layer,
+            f"chat_{chat_id}",
+            broadcast(
+                {
+                    "type": "chat.event",
+                    "event": "typing",
+                    "is_typing": True,
+                    "user_id": self.user.id,
+                    "username": self.user.username,
+                    "chat_id": int(chat_id),
+                }
+            ),
+        )
+
+    async def notify_typing_stopped(self, chat_id):
+        """Let other users know this user stopped typing in this chat"""
+        await group_send(
+            self.channel_layer,
+            f"chat_{chat_id}",
+            broadcast(
+                {
+                    "type": "chat.event",
+                    "event": "typing_stopped",
+                    "is_typing": False,
+                    "user_id": self.user.id,
+                    "username": self.user.username,
+                    "chat_id": int(chat_id),
+                }
+            ),
+        )
+
+    async def clear_typing(self):
+        """Broadcast a stop for every chat this connection is typing in"""
+        if hasattr(self, "typing_state"):
+            for chat_id in self.typing_state.clear():
+                await self.notify_typing_stopped(chat_id)
+
+    async def join_presence(self, chat_id):
+        """Register this connection in a chat and announce the first one"""
+        if await get_presence().join(chat_id, self.user.id, self.channel_name):
+            await self.notify_user_online(chat_id)
+
+    async def leave_presence(self, chat_id):
+        """Unregister this connection and announce when it was the last one"""
+        if await get_presence().leave(chat_id, self.user.id, self.channel_name):
+            await self.notify_user_offline(chat_id)
+
+    def start_heartbeat(self):
+        self.heartbeat_task = asyncio.ensure_future(self.send_heartbeats())
+
+    def stop_heartbeat(self):
+        if hasattr(self, "heartbeat_task"):
+            self.heartbeat_task.cancel()
+
+    async def send_heartbeats(self):
+        """Keep this connection's presence entries alive while it is open"""
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            try:
+                await get_presence().heartbeat(
+                    self.presence_chats(), self.user.id, self.channel_name
+                )
+            except Exception as e:
+                print(f"Presence heartbeat error: {e}")
 
+    async def send_presence(self, chat_ids):
+        """Reply with the online users of the given chats"""
+        online = await get_presence().online_users(chat_ids)
+        await self.send_event(
+            {
+                "type": "presence",
+                "chats": [
+                    {"chat_id": chat_id, "online_user_ids": user_ids}
+                    for chat_id, user_ids in online.items()
+                ],
+            }
+        )
 
-class ChatConsumer(AsyncWebsocketConsumer):
+    async def notify_user_online(self, chat_id):
+        """Let other users know this user is online in this chat"""
+        await group_send(
+            self.channel_layer,
+            f"chat_{chat_id}",
+            broadcast(
+                {
+                    "type": "chat.event",
+                    "event": "user_online",
+                    "user_id": self.user.id,
+                    "username": self.user.username,
+                    "chat_id": int(chat_id),
+                }
+            ),
+        )
+
+    async def notify_user_offline(self, chat_id):
+        """Let other users know this user went offline"""
+        await group_send(
+            self.channel_layer,
+            f"chat_{chat_id}",
+            broadcast(
+                {
+                    "type": "chat.event",
+                    "event": "user_offline",
+                    "user_id": self.user.id,
+                    "username": self.user.username,
+                    "chat_id": int(chat_id),
+                }
+            ),
+        )
+
+
+class ChatConsumer(ChatActionsMixin, EventConsumer):
     async def connect(self):
         """Handle new WebSocket connection from client"""
         self.user = self.scope["user"]
@@ -17,9 +610,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
         self.chat_group_name = f"chat_{self.chat_id}"
         self.user_group_name = f"user_{self.user.id}"
+        self.typing_state = TypingState(self.user.id, self.notify_typing_stopped)
+        self.replayed_up_to = {}
 
         # Verify user is participant
-        is_participant = await self.is_chat_participant()
+        is_participant = await self.is_chat_participant(self.chat_id)
         if not is_participant:
             await self.close()
             return
@@ -32,11 +627,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        # Resume from the client's cursor before switching to live events
+        query_params = parse_qs(self.scope.get("query_string", b"").decode())
+        await self.resume(
+            self.chat_id, {key: values[0] for key, values in query_params.items()}
+        )
+
         # Mark messages as delivered when user connects
-        await self.mark_messages_as_delivered()
+        await self.mark_messages_as_delivered(self.chat_id)
 
         # Notify other users about this user's online status
-        await self.notify_user_online()
+        await self.join_presence(int(self.chat_id))
+        self.start_heartbeat()
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
@@ -52,198 +654,180 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.user_group_name, self.channel_name
             )
 
+        # Close any typing indicator left open by this socket
+        await self.clear_typing()
+
         # Notify others about user going offline
+        self.stop_heartbeat()
         if (
             hasattr(self, "user")
             and not self.user.is_anonymous
             and hasattr(self, "chat_id")
         ):
-            await self.notify_user_offline()
+            await self.leave_presence(int(self.chat_id))
+
+    def presence_chats(self):
+        return [int(self.chat_id)]
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
+    async def receive_event(self, data):
         """Process messages received from clients"""
-        try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get("type", "chat_message")
-
-            if message_type == "chat_message":
-                # Handle new chat message
-                content = text_data_json.get("message", "")
-                if not content:
-                    return
-
-                # Save message to database
-                message_obj = await self.save_message(content)
-
-                # Send message to room group
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        "type": "chat.message",
-                        "message": {
-                            "id": message_obj.id,
-                            "content": content,
-                            "sender_id": self.user.id,
-                            "sender_username": self.user.username,
-                            "sender_profile_img": getattr(
-                                self.user, "profile_img", None
-                            ),
-                            "sent_at": message_obj.sent_at.isoformat(),
-                            "status": "sent",
-                            "chat_id": int(self.chat_id),
-                        },
-                    },
-                )
-
-            elif message_type == "typing":
-                # Broadcast typing indicator
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        "type": "chat.event",
-                        "event": "typing",
-                        "user_id": self.user.id,
-                        "username": self.user.username,
-                        "chat_id": int(self.chat_id),
-                    },
-                )
-
-            elif message_type == "read_messages":
-                # Mark messages as read
-                await self.mark_messages_as_read()
-
-                # Notify others
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        "type": "chat.event",
-                        "event": "mensajes_leidos",
-                        "user_id": self.user.id,
-                        "chat_id": int(self.chat_id),
-                    },
-                )
-
-            elif message_type == "delivered_messages":
-                # Mark messages as delivered
-                await self.mark_messages_as_delivered()
-
-                # Notify others
-                await self.channel_layer.group_send(
-                    self.chat_group_name,
-                    {
-                        "type": "chat.event",
-                        "event": "mensajes_entregados",
-                        "user_id": self.user.id,
-                        "chat_id": int(self.chat_id),
-                    },
-                )
-        except json.JSONDecodeError:
-            pass
-        except Exception as e:
-            print(f"Error processing WebSocket message: {e}")
+        await self.handle_chat_frame(self.chat_id, data)
 
     # Receive message from chat group
     async def chat_message(self, event):
         """Forward chat messages to the WebSocket client"""
+        if self.already_replayed(event):
+            return
+
         # Send message to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "chat_message",
-                    "message": event["message"],
-                }
-            )
-        )
+        await self.send_broadcast(event)
 
     # Handle chat events
     async def chat_event(self, event):
         """Forward chat events to the WebSocket client"""
+        if event.get("user_copy") and event.get("chat_id") == int(self.chat_id):
+            # Also delivered through the chat group
+            return
+
         # Forward the event to WebSocket
-        await self.send(text_data=json.dumps(event))
+        await self.send_broadcast(event)
 
-    @database_sync_to_async
-    def is_chat_participant(self):
-        """Check if current user is a participant in the chat"""
-        return ChatParticipant.objects.filter(
-            chat_id=self.chat_id, user=self.user
-        ).exists()
 
-    @database_sync_to_async
-    def save_message(self, content):
-        """Save a new message to the database"""
-        chat = Chat.objects.get(id=self.chat_id)
-        message = Message.objects.create(chat=chat, sender=self.user, content=content)
+class MultiplexConsumer(ChatActionsMixin, EventConsumer):
+    """
+    Single per-user socket carrying every chat the client subscribes to.
 
-        # Create message status entries for all participants except sender
-        participants = ChatParticipant.objects.filter(chat=chat).exclude(user=self.user)
-        for participant in participants:
-            MessageStatus.objects.create(message=message, receiver=participant.user)
+    Clients send ``{"type": "subscribe", "chat_id": ...}`` and
+    ``{"type": "unsubscribe", "chat_id": ...}`` frames; every other chat frame
+    (``chat_message``, ``typing``, ``read_messages``, ``delivered_messages``)
+    must carry the ``chat_id`` it targets. Outgoing events are tagged with
+    their ``chat_id`` and user-level notifications arrive only once.
+    """
 
-        return message
+    async def connect(self):
+        self.user = self.scope["user"]
 
-    @database_sync_to_async
-    def mark_messages_as_delivered(self):
-        """Mark all messages as delivered for the current user"""
-        unread_statuses = MessageStatus.objects.filter(
-            message__chat_id=self.chat_id, receiver=self.user, status="sent"
-        )
+        # Make sure user is authenticated
+        if self.user.is_anonymous:
+            await self.close()
+            return
 
-        for status in unread_statuses:
-            status.status = "delivered"
-            status.save()
+        self.user_group_name = f"user_{self.user.id}"
+        self.subscribed_chats = set()
+        self.typing_state = TypingState(self.user.id, self.notify_typing_stopped)
+        self.replayed_up_to = {}
 
-            # We'll notify about this status change in a separate task
-            from chat.tasks import notify_message_status_change
+        # Join user-specific group once for the whole connection
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
 
-            notify_message_status_change(status.id)
+        await self.accept()
+        self.start_heartbeat()
 
-    @database_sync_to_async
-    def mark_messages_as_read(self):
-        """Mark all messages as read for the current user"""
-        unread_statuses = MessageStatus.objects.filter(
-            message__chat_id=self.chat_id,
-            receiver=self.user,
-            status__in=["sent", "delivered"],
+        await self.send_event(
+            {
+                "type": "connection_established",
+                "message": "Connected to multiplexed chat channel",
+            }
         )
 
-        for status in unread_statuses:
-            status.status = "read"
-            status.save()
+    async def disconnect(self, close_code):
+        self.stop_heartbeat()
 
-            # We'll notify about this status change in a separate task
-            from chat.tasks import notify_message_status_change
+        # Leave every chat group this socket joined
+        for chat_id in list(getattr(self, "subscribed_chats", ())):
+            await self.unsubscribe(chat_id)
 
-            notify_message_status_change(status.id)
+        if hasattr(self, "user_group_name"):
+            await self.channel_layer.group_discard(
+                self.user_group_name, self.channel_name
+            )
 
-    async def notify_user_online(self):
-        """Let other users know this user is online in this chat"""
-        await self.channel_layer.group_send(
-            self.chat_group_name,
-            {
-                "type": "chat.event",
-                "event": "user_online",
-                "user_id": self.user.id,
-                "username": self.user.username,
-                "chat_id": int(self.chat_id),
-            },
-        )
+    async def receive_event(self, data):
+        """Route client frames to the chat they target"""
+        message_type = data.get("type", "chat_message")
+        chat_id = data.get("chat_id")
+
+        if message_type == "presence_query" and "chat_ids" in data:
+            # Bulk lookup restricted to the chats this socket follows
+            requested = {str(chat_id) for chat_id in data["chat_ids"]}
+            chat_ids = [
+                chat_id
+                for chat_id in self.subscribed_chats
+                if str(chat_id) in requested
+            ]
+            await self.send_presence(sorted(chat_ids))
+            return
 
-    async def notify_user_offline(self):
-        """Let other users know this user went offline"""
-        await self.channel_layer.group_send(
-            self.chat_group_name,
-            {
-                "type": "chat.event",
-                "event": "user_offline",
-                "user_id": self.user.id,
-                "username": self.user.username,
-                "chat_id": int(self.chat_id),
-            },
-        )
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            await self.send_error(chat_id, "A valid chat_id is required.")
+            return
 
+        if message_type == "subscribe":
+            await self.subscribe(chat_id, resume_from=data)
+        elif message_type == "unsubscribe":
+            await self.unsubscribe(chat_id)
+            await self.send_event({"type": "unsubscribed", "chat_id": chat_id})
+        elif chat_id not in self.subscribed_chats:
+            await self.send_error(chat_id, "Not subscribed to this chat.")
+        else:
+            await self.handle_chat_frame(chat_id, data)
+
+    async def subscribe(self, chat_id, resume_from=None):
+        """Join a chat group after verifying membership"""
+        if chat_id in self.subscribed_chats:
+            return
 
-class UserConsumer(AsyncWebsocketConsumer):
+        if not await self.is_chat_participant(chat_id):
+            await self.send_error(chat_id, "You are not a participant in this chat.")
+            return
+
+        await self.channel_layer.group_add(f"chat_{chat_id}", self.channel_name)
+        self.subscribed_chats.add(chat_id)
+
+        await self.send_event({"type": "subscribed", "chat_id": chat_id})
+
+        if resume_from:
+            await self.resume(chat_id, resume_from)
+
+        # Same side effects as opening a dedicated chat socket
+        await self.mark_messages_as_delivered(chat_id)
+        await self.join_presence(chat_id)
+
+    async def unsubscribe(self, chat_id):
+        """Leave a chat group"""
+        if chat_id not in self.subscribed_chats:
+            return
+
+        self.subscribed_chats.discard(chat_id)
+        self.replayed_up_to.pop(chat_id, None)
+        await self.channel_layer.group_discard(f"chat_{chat_id}", self.channel_name)
+        if self.typing_state.stop(chat_id):
+            await self.notify_typing_stopped(chat_id)
+        await self.leave_presence(chat_id)
+
+    def presence_chats(self):
+        return list(self.subscribed_chats)
+
+    async def chat_message(self, event):
+        """Forward chat messages tagged with their chat"""
+        if self.already_replayed(event):
+            return
+
+        await self.send_broadcast(event)
+
+    async def chat_event(self, event):
+        """Forward chat and user-level events"""
+        if event.get("user_copy") and event.get("chat_id") in self.subscribed_chats:
+            # Also delivered through the chat group
+            return
+
+        await self.send_broadcast(event)
+
+
+class UserConsumer(EventConsumer):
     """Consumer for user-specific notifications (new chats, etc)"""
 
     async def connect(self):
@@ -262,13 +846,11 @@ class UserConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
         # Notify that user is available for notifications
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "connection_established",
-                    "message": "Connected to personal notification channel",
-                }
-            )
+        await self.send_event(
+            {
+                "type": "connection_established",
+                "message": "Connected to personal notification channel",
+            }
         )
 
     async def disconnect(self, close_code):
@@ -281,4 +863,4 @@ class UserConsumer(AsyncWebsocketConsumer):
     # Handle chat events for the user
     async def chat_event(self, event):
         # Forward the event to WebSocket
-        await self.send(text_data=json.dumps(event))
+        await self.send_broadcast(event)
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_executor = None
+
+
+def get_db_executor():
+    """
+    Thread pool running the database work of WebSocket consumers.
+
+    Returns ``None`` when ``WS_DB_EXECUTOR_WORKERS`` is 0, in which case
+    calls go through the single thread-sensitive executor as before.
+    """
+    global _executor
+    workers = getattr(settings, "WS_DB_EXECUTOR_WORKERS", 0)
+    if _executor is None and workers > 0:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ws-db")
+    return _executor
+
+
+class ConsumerDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    ``database_sync_to_async`` running on the consumers' database pool.
+
+    Each call runs entirely on one pool thread, so transactions opened
+    inside the wrapped function behave as in synchronous code, while calls
+    for different chats no longer queue behind each other. Every worker
+    thread keeps its own database connection.
+    """
+
+    def __init__(self, func):
+        executor = get_db_executor()
+        super().__init__(func, thread_sensitive=executor is None, executor=executor)
+
+
+db_sync_to_async = ConsumerDatabaseSyncToAsync
@@ -0,0 +1,352 @@
+import asyncio
+import heapq
+import time
+from collections import OrderedDict
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer
+from core.metrics import GROUP_SEND_SECONDS
+
+# Same as channels_redis' group send: push each message onto its key unless
+# the key is at capacity, returning how many keys were full
+GROUP_SEND_SCRIPT = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+async def group_send(channel_layer, group, message):
+    """``channel_layer.group_send``, recording its latency"""
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, message)
+    finally:
+        GROUP_SEND_SECONDS.observe(time.perf_counter() - started)
+
+
+class NodeFanoutChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that fans group messages out on each node.
+
+    Group members created by this layer are kept in an in-process registry,
+    and Redis only records which nodes have members in a group. A group send
+    pushes one small copy of the message per node, and each node hands it to
+    its own member channels from the registry, instead of every send reading
+    and carrying the names of all member channels.
+
+    Channels from other processes (e.g. plain worker channels) are stored and
+    delivered exactly as by ``RedisChannelLayer``. Every process sharing the
+    Redis prefix must use this layer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (group, node) -> {member channel of this process: join time}
+        self.local_groups = {}
+
+    def _local_node(self, channel):
+        """The node key of a channel created by this layer, else ``None``"""
+        if "!" not in channel:
+            return None
+        node = self.non_local_name(channel)
+        if not node.endswith(self.client_prefix + "!"):
+            return None
+        return node
+
+    async def _join_node(self, group, node):
+        connection = self.connection(self.consistent_hash(group))
+        await connection.zadd(self._group_key(group), {node: time.time()})
+        await connection.expire(self._group_key(group), self.group_expiry)
+
+    async def group_add(self, group, channel):
+        node = self._local_node(channel)
+        if node is None:
+            return await super().group_add(group, channel)
+
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        # Re-adding renews the membership, and expired ones are dropped
+        self._local_members(group, node)
+        self.local_groups.setdefault((group, node), {})[channel] = time.time()
+        # Refreshed on every add so the node expires like a channel would
+        await self._join_node(group, node)
+
+    async def group_discard(self, group, channel):
+        node = self._local_node(channel)
+        if node is None:
+            return await super().group_discard(group, channel)
+
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        members = self.local_groups.get((group, node))
+        if members is None:
+            return
+        members.pop(channel, None)
+        if members:
+            return
+
+        del self.local_groups[(group, node)]
+        connection = self.connection(self.consistent_hash(group))
+        await connection.zrem(self._group_key(group), node)
+        if (group, node) in self.local_groups:
+            # A channel joined while the node was being removed
+            await self._join_node(group, node)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert "__asgi_group__" not in message
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        await connection.zremrangebyscore(
+            key, min=0, max=int(time.time()) - self.group_expiry
+        )
+        members = [x.decode("utf8") for x in await connection.zrange(key, 0, -1)]
+        nodes = [member for member in members if member.endswith("!")]
+        channels = [member for member in members if not member.endswith("!")]
+
+        (
+            connection_to_keys,
+            key_to_message,
+            key_to_capacity,
+        ) = self._map_channel_keys_to_connection(channels, message)
+
+        if nodes:
+            fanout = self.serialize({**message, "__asgi_group__": group})
+            for node in nodes:
+                node_key = self.prefix + node
+                connection_to_keys[self.consistent_hash(node)].append(node_key)
+                key_to_message[node_key] = fanout
+                key_to_capacity[node_key] = self.get_capacity(node)
+
+        for index, keys in connection_to_keys.items():
+            connection = self.connection(index)
+            now = time.time()
+            async with connection.pipeline(transaction=False) as pipe:
+                for channel_key in keys:
+                    pipe.zremrangebyscore(
+                        channel_key, min=0, max=int(now) - int(self.expiry)
+                    )
+                await pipe.execute()
+
+            args = [key_to_message[channel_key] for channel_key in keys]
+            args += [key_to_capacity[channel_key] for channel_key in keys]
+            args += [now, self.expiry]
+            over_capacity = await connection.eval(
+                GROUP_SEND_SCRIPT, len(keys), *keys, *args
+            )
+            if over_capacity > 0:
+                print(
+                    f"Channel layer: {over_capacity} of {len(keys)} channels "
+                    f"over capacity in group {group}"
+                )
+
+    async def receive_single(self, channel):
+        channel, message = await super().receive_single(channel)
+        group = message.pop("__asgi_group__", None)
+        if group is not None:
+            # Delivered once for the node: hand it to the local members
+            channel = self._local_members(group, channel)
+        return channel, message
+
+    def _local_members(self, group, node):
+        """Live member channels, dropping those past the group expiry"""
+        members = self.local_groups.get((group, node))
+        if not members:
+            return []
+        timeout = time.time() - self.group_expiry
+        expired = [channel for channel, joined in members.items() if joined < timeout]
+        for channel in expired:
+            del members[channel]
+        if not members:
+            # The node's Redis entry expires on its own
+            del self.local_groups[(group, node)]
+        return list(members)
+
+    async def flush(self):
+        self.local_groups.clear()
+        await super().flush()
+
+
+class FrozenDict(dict):
+    """Read-only dict, safe to hand to every receiver of a message"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Channel layer messages are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def freeze(value):
+    """Read-only copy of a message: dicts become FrozenDicts, lists tuples"""
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class LocalChannelLayer(InMemoryChannelLayer):
+    """
+    In-process channel layer for single-process deployments.
+
+    Behaves like ``InMemoryChannelLayer`` (per-channel capacity, message
+    expiry dropping the channel from its groups, group expiry) but keeps
+    indexes so that no operation scans every channel or group:
+
+    - ``groups`` maps each group to a set of channels and ``channel_groups``
+      each channel to its groups;
+    - memberships are kept in join order and expire from the front;
+    - a heap holds the oldest pending message expiry of each channel.
+
+    Messages are frozen once per send and the same read-only copy is queued
+    for every member, instead of a deep copy per member.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset()
+
+    def _reset(self):
+        self.channels = {}
+        # group -> channels, and channel -> groups
+        self.groups = {}
+        self.channel_groups = {}
+        # (group, channel) -> join time, oldest first
+        self.memberships = OrderedDict()
+        # (expiry, channel) of the oldest message of channels with messages
+        self.expiring = []
+        self.tracked = set()
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(
+                maxsize=self.get_capacity(channel)
+            )
+        return queue
+
+    def _put(self, channel, message):
+        """Queue a frozen message, raising ChannelFull at capacity"""
+        queue = self._queue(channel)
+        expires = time.time() + self.expiry
+        try:
+            queue.put_nowait((expires, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+        if channel not in self.tracked:
+            self.tracked.add(channel)
+            heapq.heappush(self.expiring, (expires, channel))
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        self._put(channel, freeze(message))
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self._clean_expired()
+
+        queue = self._queue(channel)
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty():
+                self.channels.pop(channel, None)
+        return message
+
+    def _clean_expired(self):
+        now = time.time()
+        while self.expiring and self.expiring[0][0] < now:
+            _, channel = heapq.heappop(self.expiring)
+            self.tracked.discard(channel)
+            queue = self.channels.get(channel)
+            if queue is None or queue.empty():
+                # Read since it was tracked; a receiver may be waiting on it
+                continue
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+                self._remove_from_groups(channel)
+            if queue.empty():
+                # It held messages, so nothing was waiting on it
+                self.channels.pop(channel, None)
+            else:
+                # Track the channel's next oldest message
+                self.tracked.add(channel)
+                heapq.heappush(self.expiring, (queue._queue[0][0], channel))
+
+        timeout = int(now) - self.group_expiry
+        while self.memberships:
+            (group, channel), joined = next(iter(self.memberships.items()))
+            if joined >= timeout:
+                break
+            self._discard(group, channel)
+
+    async def flush(self):
+        self._reset()
+
+    def _remove_from_groups(self, channel):
+        for group in list(self.channel_groups.get(channel, ())):
+            self._discard(group, channel)
+
+    def _discard(self, group, channel):
+        self.memberships.pop((group, channel), None)
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.groups.setdefault(group, set()).add(channel)
+        self.channel_groups.setdefault(channel, set()).add(group)
+        # Re-adding renews the membership
+        self.memberships[(group, channel)] = time.time()
+        self.memberships.move_to_end((group, channel))
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        assert "__asgi_channel__" not in message
+        self._clean_expired()
+
+        message = freeze(message)
+        for channel in self.groups.get(group, ()):
+            try:
+                self._put(channel, message)
+            except ChannelFull:
+                pass
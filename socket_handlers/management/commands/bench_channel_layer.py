@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from core.benchmarking import summarize, write_report
+
+LAYERS = {
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "fanout": "socket_handlers.layers.NodeFanoutChannelLayer",
+    "memory": "channels.layers.InMemoryChannelLayer",
+    "local": "socket_handlers.layers.LocalChannelLayer",
+}
+
+# Layers living in a single process, run as one node without Redis
+IN_PROCESS = {"memory", "local"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure group_send delivery latency and Redis traffic of the stock "
+        "channel layers against the node fan-out and local layers"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="10,100,500,1000",
+            help="Comma separated list of group sizes",
+        )
+        parser.add_argument(
+            "--nodes", type=int, default=2, help="Layer instances sharing a group"
+        )
+        parser.add_argument(
+            "--messages", type=int, default=100, help="Group sends per size"
+        )
+        parser.add_argument(
+            "--layers",
+            default="redis,fanout",
+            help=f"Comma separated list of layers to compare ({', '.join(LAYERS)})",
+        )
+        parser.add_argument(
+            "--redis-url", help="Redis server, defaults to the configured layer's"
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+        parser.add_argument("--output", help="Also write the JSON report here")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",") if size]
+        names = [name for name in options["layers"].split(",") if name]
+        for name in names:
+            if name not in LAYERS:
+                raise CommandError(f"Unknown layer {name}")
+
+        url = options["redis_url"] or self.configured_url()
+        if not url and not IN_PROCESS.issuperset(names):
+            raise CommandError("Set REDIS_URL or pass --redis-url")
+
+        rows = []
+        for size in sizes:
+            for name in names:
+                rows.append(
+                    async_to_sync(self.run_layer)(
+                        name, url, size, options["nodes"], options["messages"]
+                    )
+                )
+
+        write_report(
+            self,
+            {"benchmark": "channel_layer", "rows": rows},
+            options["json"],
+            options["output"],
+        )
+
+    def configured_url(self):
+        config = settings.CHANNEL_LAYERS.get("default", {}).get("CONFIG", {})
+        hosts = config.get("hosts") or [os.environ.get("REDIS_URL")]
+        return hosts[0]
+
+    async def run_layer(self, name, url, size, nodes, messages):
+        """Send ``messages`` to a group of ``size`` channels spread over nodes"""
+        backend = import_string(LAYERS[name])
+        if name in IN_PROCESS:
+            nodes = 1
+            layers = [backend(capacity=messages + 10)]
+        else:
+            # A throwaway prefix keeps the run apart from live traffic
+            prefix = f"bench-{uuid.uuid4().hex[:8]}"
+            layers = [
+                backend(hosts=[url], prefix=prefix, capacity=messages + 10)
+                for _ in range(nodes)
+            ]
+        group = "bench"
+
+        members = []
+        for i in range(size):
+            layer = layers[i % nodes]
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            members.append((layer, channel))
+
+        try:
+            before = await self.redis_stats(layers[0])
+            samples = []
+            started = time.perf_counter()
+            for i in range(messages):
+                sent = time.perf_counter()
+                await layers[0].group_send(group, {"type": "bench.message", "n": i})
+                await asyncio.gather(
+                    *(layer.receive(channel) for layer, channel in members)
+                )
+                samples.append((time.perf_counter() - sent) * 1000)
+            elapsed = time.perf_counter() - started
+            after = await self.redis_stats(layers[0])
+        finally:
+            await layers[0].flush()
+            for layer in layers:
+                if hasattr(layer, "close_pools"):
+                    await layer.close_pools()
+
+        summary = summarize(samples)
+        return {
+            "layer": name,
+            "nodes": nodes,
+            "group_size": size,
+            "messages": summary.pop("count"),
+            "deliveries_per_second": round(size * messages / elapsed, 1),
+            **{f"{key}_ms": value for key, value in summary.items()},
+            **{
+                f"redis_{key}_per_message": round(
+                    (after[key] - before[key]) / max(messages, 1), 1
+                )
+                for key in after
+            },
+        }
+
+    async def redis_stats(self, layer):
+        """Commands processed and bytes moved by the Redis server so far"""
+        if not hasattr(layer, "connection"):
+            return {}
+        info = await layer.connection(0).info("stats")
+        return {
+            "commands": info.get("total_commands_processed", 0),
+            "input_bytes": info.get("total_net_input_bytes", 0),
+            "output_bytes": info.get("total_net_output_bytes", 0),
+        }
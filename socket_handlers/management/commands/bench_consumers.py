@@ -0,0 +1,134 @@
+import asyncio
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import Chat, ChatParticipant
+from core.benchmarking import summarize, write_report
+
+User = get_user_model()
+
+ORIGIN = [(b"origin", b"http://localhost")]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure chat message throughput and latency through ChatConsumer "
+        "against the number of concurrently active chats"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chats",
+            default="1,10,50,100",
+            help="Comma separated list of concurrent chat counts",
+        )
+        parser.add_argument(
+            "--messages", type=int, default=50, help="Messages sent per chat"
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+        parser.add_argument("--output", help="Also write the JSON report here")
+
+    def handle(self, *args, **options):
+        counts = [int(count) for count in options["chats"].split(",") if count]
+        rows = []
+
+        for count in counts:
+            rows.append(async_to_sync(self.run_chats)(count, options["messages"]))
+
+        write_report(
+            self,
+            {
+                "benchmark": "consumers",
+                "db_executor_workers": settings.WS_DB_EXECUTOR_WORKERS,
+                "rows": rows,
+            },
+            options["json"],
+            options["output"],
+        )
+
+    async def run_chats(self, count, messages):
+        """Send ``messages`` per chat over ``count`` chat sockets at once"""
+        from core.asgi import application
+
+        prefix = f"bench_{uuid.uuid4().hex[:8]}"
+        chats = await database_sync_to_async(self.create_chats)(prefix, count)
+
+        sockets = []
+        try:
+            for chat, user in chats:
+                token = str(AccessToken.for_user(user))
+                communicator = WebsocketCommunicator(
+                    application, f"/ws/chat/{chat.id}/?token={token}", headers=ORIGIN
+                )
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise RuntimeError(f"Could not connect to chat {chat.id}")
+                sockets.append(communicator)
+
+            started = time.perf_counter()
+            results = await asyncio.gather(
+                *(self.send_messages(socket, messages) for socket in sockets)
+            )
+            elapsed = time.perf_counter() - started
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
+            await database_sync_to_async(self.delete_chats)(prefix)
+
+        samples = [sample for result in results for sample in result]
+        summary = summarize(samples)
+        return {
+            "chats": count,
+            "messages": summary.pop("count"),
+            "messages_per_second": round(len(samples) / elapsed, 1),
+            **{f"{key}_ms": value for key, value in summary.items()},
+        }
+
+    async def send_messages(self, communicator, messages):
+        """Send messages one after another, timing each until its broadcast"""
+        samples = []
+        for i in range(messages):
+            content = f"bench {i}"
+            started = time.perf_counter()
+            await communicator.send_json_to(
+                {"type": "chat_message", "message": content}
+            )
+            while True:
+                frame = await communicator.receive_json_from(timeout=30)
+                if (
+                    frame.get("type") == "chat_message"
+                    and frame["message"]["content"] == content
+                ):
+                    break
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+
+    def create_chats(self, prefix, count):
+        """Chats of two members each, returning each chat with its sender"""
+        users = User.objects.bulk_create(
+            [
+                User(username=f"{prefix}_{i}", email=f"{prefix}_{i}@bench.local")
+                for i in range(count * 2)
+            ]
+        )
+        chats = Chat.objects.bulk_create(
+            [Chat(name=f"{prefix}_{i}") for i in range(count)]
+        )
+        ChatParticipant.objects.bulk_create(
+            [
+                ChatParticipant(chat=chat, user=user)
+                for i, chat in enumerate(chats)
+                for user in users[i * 2 : i * 2 + 2]
+            ]
+        )
+        return [(chat, users[i * 2]) for i, chat in enumerate(chats)]
+
+    def delete_chats(self, prefix):
+        Chat.objects.filter(name__startswith=f"{prefix}_").delete()
+        User.objects.filter(username__startswith=f"{prefix}_").delete()
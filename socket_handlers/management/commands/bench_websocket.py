@@ -0,0 +1,295 @@
+import asyncio
+import random
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import Chat, ChatParticipant
+from core.benchmarking import (
+    QueryCounter,
+    current_rss_mb,
+    peak_rss_mb,
+    summarize,
+    write_report,
+)
+from socket_handlers.protocol import negotiate
+
+User = get_user_model()
+
+ORIGIN = [(b"origin", b"http://localhost")]
+
+
+class Client:
+    """One simulated user holding a chat socket"""
+
+    def __init__(self, user, chat_id, communicator, codec, batch):
+        self.user = user
+        self.chat_id = chat_id
+        self.communicator = communicator
+        self.codec = codec
+        self.batch = batch
+        self.sent = 0
+        self.typing = 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the WebSocket stack in process: N users spread over M "
+        "chats send messages and typing frames through core.asgi.application"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--chats", type=int, default=10)
+        parser.add_argument(
+            "--duration", type=float, default=10, help="Seconds of sending"
+        )
+        parser.add_argument(
+            "--message-rate",
+            type=float,
+            default=0.5,
+            help="Messages per second sent by each user",
+        )
+        parser.add_argument(
+            "--typing-rate",
+            type=float,
+            default=1.0,
+            help="Typing frames per second sent by each user",
+        )
+        parser.add_argument(
+            "--subprotocol",
+            help="Subprotocol requested by the clients, e.g. besage.msgpack+batch",
+        )
+        parser.add_argument(
+            "--grace",
+            type=float,
+            default=10,
+            help="Seconds to wait for outstanding deliveries after sending",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--json", action="store_true", help="Print JSON")
+        parser.add_argument("--output", help="Also write the JSON report here")
+
+    def handle(self, *args, **options):
+        if options["users"] < options["chats"] or options["chats"] < 1:
+            raise CommandError("Need at least one chat and one user per chat")
+
+        counter = QueryCounter()
+        counter.install()
+        report = async_to_sync(self.run)(counter, options)
+        write_report(self, report, options["json"], options["output"])
+
+    async def run(self, counter, options):
+        from core.asgi import application
+
+        rng = random.Random(options["seed"])
+        prefix = f"bench_{uuid.uuid4().hex[:8]}"
+        members = await database_sync_to_async(self.create_chats)(
+            prefix, options["users"], options["chats"]
+        )
+        chat_sizes = {}
+        for _, chat_id in members:
+            chat_sizes[chat_id] = chat_sizes.get(chat_id, 0) + 1
+
+        subprotocols = [options["subprotocol"]] if options["subprotocol"] else None
+        codec, _, batch = negotiate(subprotocols)
+
+        # content -> send time, shared by every receiver
+        in_flight = {}
+        latencies = []
+        received = {"frames": 0, "deliveries": 0, "by_type": {}}
+        clients = []
+        connect_ms = []
+        rss_before = current_rss_mb()
+
+        try:
+            for user, chat_id in members:
+                token = str(AccessToken.for_user(user))
+                communicator = WebsocketCommunicator(
+                    application,
+                    f"/ws/chat/{chat_id}/?token={token}",
+                    headers=ORIGIN,
+                    subprotocols=subprotocols,
+                )
+                started = time.perf_counter()
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise CommandError(f"Could not connect to chat {chat_id}")
+                connect_ms.append((time.perf_counter() - started) * 1000)
+                clients.append(Client(user, chat_id, communicator, codec, batch))
+            rss_connected = current_rss_mb()
+
+            receivers = [
+                asyncio.ensure_future(
+                    self.receive(client, in_flight, latencies, received)
+                )
+                for client in clients
+            ]
+
+            counter.reset()
+            counter.active = True
+            started = time.perf_counter()
+            deadline = started + options["duration"]
+            await asyncio.gather(
+                *(
+                    self.send_messages(
+                        client, options["message_rate"], deadline, rng, in_flight
+                    )
+                    for client in clients
+                ),
+                *(
+                    self.send_typing(client, options["typing_rate"], deadline, rng)
+                    for client in clients
+                ),
+            )
+            sent = sum(client.sent for client in clients)
+            expected = sum(
+                chat_sizes[client.chat_id] * client.sent for client in clients
+            )
+
+            # Wait for the deliveries still on their way
+            grace_deadline = time.perf_counter() + options["grace"]
+            while (
+                received["deliveries"] < expected
+                and time.perf_counter() < grace_deadline
+            ):
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+            counter.active = False
+
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.gather(*receivers, return_exceptions=True)
+        finally:
+            counter.active = False
+            for client in clients:
+                await client.communicator.disconnect()
+            await database_sync_to_async(self.delete_chats)(prefix)
+
+        latency = summarize(latencies)
+        latency_columns = {
+            f"{key}_ms": value for key, value in latency.items() if key != "count"
+        }
+        return {
+            "benchmark": "websocket",
+            "config": {
+                "users": options["users"],
+                "chats": options["chats"],
+                "duration": options["duration"],
+                "message_rate": options["message_rate"],
+                "typing_rate": options["typing_rate"],
+                "subprotocol": options["subprotocol"],
+                "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+                "db_executor_workers": settings.WS_DB_EXECUTOR_WORKERS,
+            },
+            "connect_ms": summarize(connect_ms),
+            "messages_sent": sent,
+            "typing_sent": sum(client.typing for client in clients),
+            "deliveries": received["deliveries"],
+            "deliveries_expected": expected,
+            "frames_received": received["frames"],
+            "frames_by_event": received["by_type"],
+            "messages_per_second": round(sent / elapsed, 1),
+            "deliveries_per_second": round(received["deliveries"] / elapsed, 1),
+            "latency_ms": latency,
+            "queries": {
+                "total": counter.queries,
+                "per_message": round(counter.queries / max(sent, 1), 2),
+                "db_ms_per_message": round(counter.seconds * 1000 / max(sent, 1), 3),
+            },
+            "memory_mb": {
+                "rss_before": rss_before,
+                "rss_connected": rss_connected,
+                "rss_after": current_rss_mb(),
+                "peak_rss": peak_rss_mb(),
+            },
+            "rows": [
+                {
+                    "users": options["users"],
+                    "chats": options["chats"],
+                    "messages": sent,
+                    "deliveries": received["deliveries"],
+                    "deliveries_per_second": round(received["deliveries"] / elapsed, 1),
+                    **latency_columns,
+                    "queries_per_message": round(counter.queries / max(sent, 1), 2),
+                    "rss_mb": current_rss_mb(),
+                }
+            ],
+        }
+
+    async def send_messages(self, client, rate, deadline, rng, in_flight):
+        """Send chat messages at ``rate`` per second with random spacing"""
+        if rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            if time.perf_counter() >= deadline:
+                return
+            content = f"bench {client.user.id} {client.sent}"
+            in_flight[content] = time.perf_counter()
+            client.sent += 1
+            await client.communicator.send_json_to(
+                {"type": "chat_message", "message": content}
+            )
+
+    async def send_typing(self, client, rate, deadline, rng):
+        """Send typing frames at ``rate`` per second with random spacing"""
+        if rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            if time.perf_counter() >= deadline:
+                return
+            client.typing += 1
+            await client.communicator.send_json_to({"type": "typing"})
+
+    async def receive(self, client, in_flight, latencies, received):
+        """Read frames until cancelled, timing every chat message delivery"""
+        while True:
+            # Waiting on the queue directly: a receive timeout would cancel
+            # the consumer
+            output = await client.communicator.output_queue.get()
+            if output["type"] != "websocket.send":
+                return
+            payload = client.codec.decode(output.get("text"), output.get("bytes"))
+            frames = (
+                payload if client.batch and isinstance(payload, list) else [payload]
+            )
+            for frame in frames:
+                received["frames"] += 1
+                kind = frame.get("event") or frame.get("type")
+                received["by_type"][kind] = received["by_type"].get(kind, 0) + 1
+                if frame.get("type") != "chat_message":
+                    continue
+                sent_at = in_flight.get(frame["message"]["content"])
+                if sent_at is not None:
+                    received["deliveries"] += 1
+                    latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    def create_chats(self, prefix, users, chats):
+        """Spread ``users`` round robin over ``chats`` chats"""
+        people = User.objects.bulk_create(
+            [
+                User(username=f"{prefix}_{i}", email=f"{prefix}_{i}@bench.local")
+                for i in range(users)
+            ]
+        )
+        rooms = Chat.objects.bulk_create(
+            [Chat(name=f"{prefix}_{i}") for i in range(chats)]
+        )
+        ChatParticipant.objects.bulk_create(
+            [
+                ChatParticipant(chat=rooms[i % chats], user=user)
+                for i, user in enumerate(people)
+            ]
+        )
+        return [(user, rooms[i % chats].id) for i, user in enumerate(people)]
+
+    def delete_chats(self, prefix):
+        Chat.objects.filter(name__startswith=f"{prefix}_").delete()
+        User.objects.filter(username__startswith=f"{prefix}_").delete()
@@ -1,24 +1,121 @@
+import asyncio
+import time
 from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from urllib.parse import parse_qs
+from core.cache import TTLCache
+from core.metrics import metric_lines, register_collector
+from .db import db_sync_to_async
 
 User = get_user_model()
 
 
-@database_sync_to_async
-def get_user(user_id):
+class HandshakeStats:
+    """Counters for the time spent authenticating WebSocket handshakes"""
+
+    def __init__(self):
+        self.handshakes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.db_lookups = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, elapsed, cache_hit):
+        self.handshakes += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        if cache_hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def snapshot(self):
+        return {
+            "handshakes": self.handshakes,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "db_lookups": self.db_lookups,
+            "total_seconds": self.total_seconds,
+            "max_seconds": self.max_seconds,
+        }
+
+
+# Bounded, TTL based cache of users resolved during WebSocket handshakes,
+# dropped by the User save/delete signals
+user_cache = TTLCache(
+    maxsize=getattr(settings, "WS_USER_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "WS_USER_CACHE_TTL", 60),
+)
+handshake_stats = HandshakeStats()
+
+# Lookups in flight, shared by concurrent handshakes for the same user
+_pending_lookups = {}
+
+
+@register_collector
+def handshake_metrics():
+    stats = handshake_stats.snapshot()
+    return (
+        metric_lines(
+            "besage_ws_handshakes_total",
+            "counter",
+            "Authenticated WebSocket handshakes, by user cache result",
+            [
+                ({"cache": "hit"}, stats["cache_hits"]),
+                ({"cache": "miss"}, stats["cache_misses"]),
+            ],
+        )
+        + metric_lines(
+            "besage_ws_handshake_db_lookups_total",
+            "counter",
+            "User lookups made by WebSocket handshakes",
+            [({}, stats["db_lookups"])],
+        )
+        + metric_lines(
+            "besage_ws_handshake_seconds_total",
+            "counter",
+            "Time spent authenticating WebSocket handshakes",
+            [({}, stats["total_seconds"])],
+        )
+        + metric_lines(
+            "besage_ws_handshake_seconds_max",
+            "gauge",
+            "Slowest WebSocket handshake authentication",
+            [({}, stats["max_seconds"])],
+        )
+    )
+
+
+@db_sync_to_async
+def fetch_user(user_id):
     try:
         return User.objects.get(id=user_id)
     except User.DoesNotExist:
-        return AnonymousUser()
+        return None
 
 
-# Track active users
-active_users = {}
+async def get_user(user_id):
+    """Resolve a user through the cache, querying at most once per user"""
+    user = user_cache.get(user_id)
+    if user is None:
+        pending = _pending_lookups.get(user_id)
+        if pending is None:
+            handshake_stats.db_lookups += 1
+            pending = asyncio.ensure_future(fetch_user(user_id))
+            _pending_lookups[user_id] = pending
+            pending.add_done_callback(lambda _: _pending_lookups.pop(user_id, None))
+        user = await asyncio.shield(pending)
+        if user is not None:
+            user_cache.set(user_id, user)
+
+    if user is None or not user.is_active:
+        return AnonymousUser()
+    return user
 
 
 class JWTAuthMiddleware(BaseMiddleware):
@@ -33,31 +130,17 @@ class JWTAuthMiddleware(BaseMiddleware):
         # Get token from query parameters
         token = query_params.get("token", [None])[0]
 
+        started = time.perf_counter()
+        cache_hit = False
+
         if token:
             try:
                 # Verify token and get user ID
                 access_token = AccessToken(token)
                 user_id = access_token.payload.get("user_id")
                 if user_id:
+                    cache_hit = user_cache.get(user_id) is not None
                     scope["user"] = await get_user(user_id)
-
-                    # Track connection
-                    if user_id not in active_users:
-                        active_users[user_id] = 0
-                    active_users[user_id] += 1
-
-                    # Handle disconnect to update active users
-                    original_receive = receive
-
-                    async def receive_wrapper():
-                        message = await original_receive()
-                        if message["type"] == "websocket.disconnect":
-                            active_users[user_id] -= 1
-                            if active_users[user_id] <= 0:
-                                active_users.pop(user_id, None)
-                        return message
-
-                    receive = receive_wrapper
                 else:
                     scope["user"] = AnonymousUser()
             except (InvalidToken, TokenError):
@@ -65,4 +148,6 @@ class JWTAuthMiddleware(BaseMiddleware):
         else:
             scope["user"] = AnonymousUser()
 
+        handshake_stats.record(time.perf_counter() - started, cache_hit)
+
         return await super().__call__(scope, receive, send)
@@ -0,0 +1,202 @@
+import asyncio
+import time
+import weakref
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Adds a connection and returns 1 when it is the user's first live one
+JOIN_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local others = redis.call('ZCARD', KEYS[1])
+local added = redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+if others == 0 and added == 1 then
+  return 1
+end
+return 0
+"""
+
+# Removes a connection and returns 1 when it was the user's last live one
+LEAVE_SCRIPT = """
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+  redis.call('ZREM', KEYS[2], ARGV[3])
+  return removed
+end
+return 0
+"""
+
+
+class BasePresence:
+    """
+    Registry of live connections per chat and user.
+
+    A user is online in a chat while at least one of their connections is
+    attached to it and keeps heartbeating. ``join`` and ``leave`` return
+    ``True`` only on the online/offline transitions so callers can skip
+    broadcasts for extra tabs or sockets.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    async def join(self, chat_id, user_id, channel_name):
+        raise NotImplementedError
+
+    async def heartbeat(self, chat_ids, user_id, channel_name):
+        raise NotImplementedError
+
+    async def leave(self, chat_id, user_id, channel_name):
+        raise NotImplementedError
+
+    async def online_users(self, chat_ids):
+        """Map each chat id to the sorted ids of its online users"""
+        raise NotImplementedError
+
+
+class InMemoryPresence(BasePresence):
+    """Single process registry for development, tests and single-node runs"""
+
+    def __init__(self, ttl=60):
+        super().__init__(ttl)
+        # chat_id -> user_id -> channel_name -> expiry
+        self.chats = {}
+
+    def _live(self, connections, now):
+        for channel_name, expires in list(connections.items()):
+            if expires <= now:
+                del connections[channel_name]
+        return connections
+
+    async def join(self, chat_id, user_id, channel_name):
+        now = time.time()
+        users = self.chats.setdefault(chat_id, {})
+        connections = self._live(users.setdefault(user_id, {}), now)
+        first = not connections
+        connections[channel_name] = now + self.ttl
+        return first
+
+    async def heartbeat(self, chat_ids, user_id, channel_name):
+        expires = time.time() + self.ttl
+        for chat_id in chat_ids:
+            connections = self.chats.get(chat_id, {}).get(user_id)
+            if connections is not None and channel_name in connections:
+                connections[channel_name] = expires
+
+    async def leave(self, chat_id, user_id, channel_name):
+        users = self.chats.get(chat_id, {})
+        connections = users.get(user_id)
+        if connections is None:
+            return False
+
+        removed = connections.pop(channel_name, None) is not None
+        if self._live(connections, time.time()):
+            return False
+
+        del users[user_id]
+        if not users:
+            self.chats.pop(chat_id, None)
+        return removed
+
+    async def online_users(self, chat_ids):
+        now = time.time()
+        online = {}
+        for chat_id in chat_ids:
+            users = self.chats.get(chat_id, {})
+            online[chat_id] = sorted(
+                user_id
+                for user_id, connections in users.items()
+                if any(expires > now for expires in connections.values())
+            )
+        return online
+
+
+class RedisPresence(BasePresence):
+    """
+    Cluster-wide registry stored next to the channel layer in Redis.
+
+    ``presence:<chat>:<user>`` holds the user's connections and
+    ``presence:<chat>`` the online users, both scored by expiry time.
+    """
+
+    prefix = "presence"
+
+    def __init__(self, url, ttl=60):
+        super().__init__(ttl)
+        self.url = url
+        # Async Redis clients are bound to the event loop that created them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import redis.asyncio
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = redis.asyncio.from_url(self.url)
+            client.presence_join = client.register_script(JOIN_SCRIPT)
+            client.presence_leave = client.register_script(LEAVE_SCRIPT)
+            self._clients[loop] = client
+        return client
+
+    def _keys(self, chat_id, user_id):
+        return [f"{self.prefix}:{chat_id}:{user_id}", f"{self.prefix}:{chat_id}"]
+
+    async def join(self, chat_id, user_id, channel_name):
+        client = self._client()
+        now = time.time()
+        first = await client.presence_join(
+            keys=self._keys(chat_id, user_id),
+            args=[channel_name, now, now + self.ttl, user_id, int(self.ttl) + 1],
+        )
+        return bool(first)
+
+    async def heartbeat(self, chat_ids, user_id, channel_name):
+        client = self._client()
+        expires = time.time() + self.ttl
+        async with client.pipeline(transaction=False) as pipe:
+            for chat_id in chat_ids:
+                user_key, chat_key = self._keys(chat_id, user_id)
+                pipe.zadd(user_key, {channel_name: expires})
+                pipe.zadd(chat_key, {user_id: expires}, gt=True)
+                pipe.expire(user_key, int(self.ttl) + 1)
+                pipe.expire(chat_key, int(self.ttl) + 1)
+            await pipe.execute()
+
+    async def leave(self, chat_id, user_id, channel_name):
+        client = self._client()
+        last = await client.presence_leave(
+            keys=self._keys(chat_id, user_id),
+            args=[channel_name, time.time(), user_id],
+        )
+        return bool(last)
+
+    async def online_users(self, chat_ids):
+        client = self._client()
+        chat_ids = list(chat_ids)
+        async with client.pipeline(transaction=False) as pipe:
+            for chat_id in chat_ids:
+                pipe.zrangebyscore(f"{self.prefix}:{chat_id}", time.time(), "+inf")
+            results = await pipe.execute()
+        return {
+            chat_id: sorted(int(user_id) for user_id in members)
+            for chat_id, members in zip(chat_ids, results)
+        }
+
+
+_presence = None
+
+
+def get_presence():
+    """Return the configured presence registry, creating it on first use"""
+    global _presence
+    if _presence is None:
+        config = getattr(settings, "PRESENCE", {})
+        backend = import_string(
+            config.get("BACKEND", "socket_handlers.presence.InMemoryPresence")
+        )
+        _presence = backend(**config.get("CONFIG", {}))
+    return _presence
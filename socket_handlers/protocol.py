@@ -0,0 +1,112 @@
+import json
+import msgpack
+
+# WebSocket subprotocols a client may request at connect time
+JSON_SUBPROTOCOL = "besage.json"
+MSGPACK_SUBPROTOCOL = "besage.msgpack"
+
+# Appended to a subprotocol to receive events batched into array frames,
+# e.g. "besage.json+batch"
+BATCH_SUFFIX = "+batch"
+
+# Close code telling a client it fell too far behind and must resync
+RESYNC_CLOSE_CODE = 4008
+
+# Events that only reflect current state. Queued ones are replaced by newer
+# events of the same kind for the same chat and user, and are dropped first
+# when a client falls behind.
+EPHEMERAL_EVENTS = {
+    "typing": "typing",
+    "typing_stopped": "typing",
+    "user_online": "presence",
+    "user_offline": "presence",
+}
+
+
+class JSONCodec:
+    """Default codec: events travel as JSON text frames"""
+
+    name = "json"
+    subprotocol = JSON_SUBPROTOCOL
+
+    def dumps(self, payload):
+        return json.dumps(payload, default=str)
+
+    def frame(self, data):
+        return {"text_data": data}
+
+    def join(self, frames):
+        return "[" + ",".join(frames) + "]"
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            text_data = bytes_data.decode("utf-8")
+        return json.loads(text_data)
+
+
+class MsgpackCodec:
+    """Binary codec: the same event schema packed as msgpack binary frames"""
+
+    name = "msgpack"
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def dumps(self, payload):
+        return msgpack.packb(payload, default=str)
+
+    def frame(self, data):
+        return {"bytes_data": data}
+
+    def join(self, frames):
+        return msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Tolerate JSON text frames from msgpack clients
+            return json.loads(text_data)
+        return msgpack.unpackb(bytes_data, strict_map_key=False)
+
+
+CODECS = {
+    JSON_SUBPROTOCOL: JSONCodec(),
+    MSGPACK_SUBPROTOCOL: MsgpackCodec(),
+}
+
+
+def negotiate(subprotocols):
+    """
+    Pick the codec for a connection from the client's requested subprotocols.
+
+    Returns ``(codec, subprotocol, batch)`` where ``subprotocol`` is the
+    value to echo back on accept, or ``None`` when the client did not ask for
+    one, and ``batch`` tells whether the client accepts batched frames.
+    """
+    for subprotocol in subprotocols or ():
+        name, batch = subprotocol, False
+        if subprotocol.endswith(BATCH_SUFFIX):
+            name, batch = subprotocol[: -len(BATCH_SUFFIX)], True
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec, subprotocol, batch
+    return CODECS[JSON_SUBPROTOCOL], None, False
+
+
+def encode_frames(payload):
+    """Serialize a client frame once for every codec a socket may speak"""
+    return {codec.name: codec.dumps(payload) for codec in CODECS.values()}
+
+
+def broadcast(payload, handler="chat.event"):
+    """
+    Build a channel layer message carrying ``payload`` pre-encoded.
+
+    Receiving consumers forward the encoded frame for their codec unchanged,
+    so a group broadcast is serialized once by its sender rather than once
+    per member socket.
+    """
+    message = {"type": handler, "frames": encode_frames(payload)}
+    kind = EPHEMERAL_EVENTS.get(payload.get("event"))
+    if kind is not None:
+        message["coalesce"] = (
+            f"{kind}:{payload.get('chat_id')}:{payload.get('user_id')}"
+        )
+    return message
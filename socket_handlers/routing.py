@@ -6,4 +6,6 @@ websocket_urlpatterns = [
     path("ws/chat/<int:chat_id>/", consumers.ChatConsumer.as_asgi()),
     # User specific notification WebSocket (for new chats)
     path("ws/user/", consumers.UserConsumer.as_asgi()),
+    # Multiplexed WebSocket carrying every subscribed chat plus user events
+    path("ws/stream/", consumers.MultiplexConsumer.as_asgi()),
 ]
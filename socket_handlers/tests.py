@@ -1,3 +1,379 @@
-from django.test import TestCase
+import asyncio
+import json
+import unittest
+from collections import OrderedDict, deque
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import Chat, ChatParticipant
+from chat.services import create_message, persist_messages, prepare_message
+from .consumers import EventConsumer
+from .layers import LocalChannelLayer, NodeFanoutChannelLayer
+from .protocol import RESYNC_CLOSE_CODE, negotiate
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+User = get_user_model()
+
+
+class SocketTestCase(TransactionTestCase):
+    """Two participants of one chat, with helpers to open their sockets"""
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", email="alice@test.local")
+        self.bob = User.objects.create(username="bob", email="bob@test.local")
+        self.chat = Chat.objects.create(name="chat")
+        for user in (self.alice, self.bob):
+            ChatParticipant.objects.create(chat=self.chat, user=user)
+        self.sockets = []
+
+    async def connect(self, user, path="/ws/stream/"):
+        from core.asgi import application
+
+        communicator = WebsocketCommunicator(
+            application,
+            f"{path}?token={AccessToken.for_user(user)}",
+            headers=[(b"origin", b"http://localhost")],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.sockets.append(communicator)
+        return communicator
+
+    async def disconnect(self):
+        for communicator in self.sockets:
+            await communicator.disconnect()
+
+    async def frames(self, communicator, timeout=0.3):
+        """Every frame received until the socket stays quiet for ``timeout``"""
+        frames = []
+        while not await communicator.receive_nothing(timeout=timeout):
+            frames.append(json.loads(await communicator.receive_from()))
+        return frames
+
+    async def subscribe(self, communicator, chat_id):
+        await communicator.send_json_to({"type": "subscribe", "chat_id": chat_id})
+        return await self.frames(communicator)
+
+
+def events(frames, name):
+    return [frame for frame in frames if frame.get("event") == name]
+
+
+class StalledConsumer(EventConsumer):
+    """Consumer whose client never reads, so its frames stay queued"""
+
+    def __init__(self):
+        super().__init__()
+        self.codec, self.subprotocol, self.batching = negotiate(None)
+        self.outbox = deque()
+        self.ephemeral = OrderedDict()
+        self.flush_task = None
+        self.over_high_water_since = None
+        self.evicted = False
+        self.close_code = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await asyncio.Event().wait()
+
+    async def close(self, code=None, reason=None):
+        self.close_code = code
+
+
+@override_settings(WS_OUTBOX_HIGH_WATER=4, WS_OUTBOX_GRACE=60)
+class OutboxTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = StalledConsumer()
+
+    async def send_events(self, count, coalesce=False):
+        for index in range(count):
+            key = f"typing:{index}" if coalesce else None
+            await self.consumer.send_encoded(f"event {index}", coalesce=key)
+
+    def tearDown(self):
+        if self.consumer.flush_task is not None:
+            self.consumer.flush_task.cancel()
+
+    async def test_ephemeral_events_are_shed_first(self):
+        # The first one is being written and no longer queued
+        await self.send_events(4)
+        await asyncio.sleep(0)
+        await self.send_events(2, coalesce=True)
+
+        self.assertEqual(len(self.consumer.outbox), 3)
+        self.assertEqual(len(self.consumer.ephemeral), 0)
+        self.assertIsNone(self.consumer.close_code)
+
+    async def test_client_twice_over_the_limit_is_evicted(self):
+        await self.send_events(1)
+        await asyncio.sleep(0)
+        await self.send_events(8)
+
+        self.assertEqual(self.consumer.close_code, RESYNC_CLOSE_CODE)
+        self.assertEqual(len(self.consumer.outbox), 0)
+        await self.send_events(1)
+        self.assertEqual(len(self.consumer.outbox), 0)
+
+    @override_settings(WS_OUTBOX_GRACE=0)
+    async def test_client_over_the_limit_past_the_grace_is_evicted(self):
+        await self.send_events(1)
+        await asyncio.sleep(0)
+        await self.send_events(4)
+        self.assertIsNone(self.consumer.close_code)
+
+        await self.send_events(1)
+        self.assertEqual(self.consumer.close_code, RESYNC_CLOSE_CODE)
+
+
+class LocalChannelLayerTests(SimpleTestCase):
+    async def test_group_send_reaches_members(self):
+        layer = LocalChannelLayer()
+        first = await layer.new_channel()
+        second = await layer.new_channel()
+        await layer.group_add("chat_1", first)
+        await layer.group_add("chat_1", second)
+
+        await layer.group_send("chat_1", {"type": "chat.message", "text": "hi"})
+
+        self.assertEqual((await layer.receive(first))["text"], "hi")
+        self.assertEqual((await layer.receive(second))["text"], "hi")
+
+    async def test_idle_receiver_survives_expiry_cleanup(self):
+        layer = LocalChannelLayer(expiry=1)
+        channel = await layer.new_channel()
+        await layer.group_add("chat_1", channel)
+
+        await layer.send(channel, {"type": "chat.message", "text": "first"})
+        self.assertEqual((await layer.receive(channel))["text"], "first")
+
+        # The heap still holds the expiry of the message already read
+        waiting = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(1.2)
+        await layer.group_send("other", {"type": "chat.message"})
+        await layer.send(channel, {"type": "chat.message", "text": "second"})
+
+        message = await asyncio.wait_for(waiting, timeout=1)
+        self.assertEqual(message["text"], "second")
+
+    async def test_full_channel_raises_and_is_skipped_by_groups(self):
+        layer = LocalChannelLayer(capacity=1)
+        full = await layer.new_channel()
+        other = await layer.new_channel()
+        for channel in (full, other):
+            await layer.group_add("chat_1", channel)
+        await layer.send(full, {"type": "chat.message", "text": "first"})
+
+        with self.assertRaises(ChannelFull):
+            await layer.send(full, {"type": "chat.message", "text": "second"})
+        await layer.group_send("chat_1", {"type": "chat.message", "text": "group"})
+
+        self.assertEqual((await layer.receive(full))["text"], "first")
+        self.assertEqual((await layer.receive(other))["text"], "group")
+
+    async def test_unread_channel_leaves_its_groups(self):
+        layer = LocalChannelLayer(expiry=1)
+        stale = await layer.new_channel()
+        await layer.group_add("chat_1", stale)
+        await layer.send(stale, {"type": "chat.message"})
+
+        await asyncio.sleep(1.2)
+        await layer.group_send("chat_1", {"type": "chat.message"})
+
+        self.assertNotIn("chat_1", layer.groups)
+        self.assertNotIn(stale, layer.channels)
+
+    async def test_memberships_expire(self):
+        layer = LocalChannelLayer(group_expiry=1)
+        channel = await layer.new_channel()
+        await layer.group_add("chat_1", channel)
+        layer.memberships[("chat_1", channel)] -= 2
+
+        await layer.group_send("chat_1", {"type": "chat.message"})
+
+        self.assertEqual(layer.groups, {})
+        self.assertEqual(layer.channels, {})
+
+
+@unittest.skipUnless(fakeredis, "fakeredis is not installed")
+class NodeFanoutChannelLayerTests(SimpleTestCase):
+    def layers(self, count, **kwargs):
+        """Layers of ``count`` processes sharing one fake Redis"""
+        server = fakeredis.FakeServer()
+        layers = []
+        for _ in range(count):
+            layer = NodeFanoutChannelLayer(hosts=["redis://fake"], **kwargs)
+            client = fakeredis.aioredis.FakeRedis(server=server)
+            layer.connection = lambda index, client=client: client
+            layers.append(layer)
+        return layers
+
+    async def test_group_send_reaches_members_on_every_node(self):
+        first, second = self.layers(2)
+        channels = []
+        for layer in (first, first, second):
+            channel = await layer.new_channel()
+            await layer.group_add("chat_1", channel)
+            channels.append((layer, channel))
+        await first.group_add("chat_1", "worker")
+
+        await second.group_send("chat_1", {"type": "chat.message", "text": "hi"})
+
+        for layer, channel in channels:
+            message = await asyncio.wait_for(layer.receive(channel), timeout=1)
+            self.assertEqual(message, {"type": "chat.message", "text": "hi"})
+        message = await asyncio.wait_for(first.receive("worker"), timeout=1)
+        self.assertEqual(message["text"], "hi")
+
+    async def test_expired_members_are_dropped(self):
+        (layer,) = self.layers(1, group_expiry=1)
+        stale = await layer.new_channel()
+        live = await layer.new_channel()
+        await layer.group_add("chat_1", stale)
+        await layer.group_add("chat_1", live)
+        node = layer._local_node(stale)
+        layer.local_groups[("chat_1", node)][stale] -= 2
+
+        await layer.group_send("chat_1", {"type": "chat.message", "text": "hi"})
+
+        message = await asyncio.wait_for(layer.receive(live), timeout=1)
+        self.assertEqual(message["text"], "hi")
+        self.assertEqual(list(layer.local_groups[("chat_1", node)]), [live])
+
+
+class MultiplexConsumerTests(SocketTestCase):
+    async def test_receipts_arrive_once_per_socket(self):
+        try:
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            await self.frames(alice)
+            await self.frames(bob)
+            await self.subscribe(alice, self.chat.id)
+            await self.subscribe(bob, self.chat.id)
+            await self.frames(alice)
+
+            await alice.send_json_to(
+                {"type": "chat_message", "chat_id": self.chat.id, "message": "hi"}
+            )
+            await self.frames(bob)
+            await self.frames(alice)
+            await bob.send_json_to({"type": "read_messages", "chat_id": self.chat.id})
+
+            receipts = events(await self.frames(alice), "mensaje_estado")
+            self.assertEqual([receipt["status"] for receipt in receipts], ["read"])
+        finally:
+            await self.disconnect()
+
+    async def test_absent_sender_gets_its_own_copy(self):
+        try:
+            alice = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            await self.subscribe(bob, self.chat.id)
+            await database_sync_to_async(create_message)(self.chat.id, self.alice, "hi")
+            await self.frames(alice)
+
+            await bob.send_json_to({"type": "read_messages", "chat_id": self.chat.id})
+
+            receipts = events(await self.frames(alice), "mensaje_estado")
+            self.assertEqual([receipt["status"] for receipt in receipts], ["read"])
+        finally:
+            await self.disconnect()
+
+    async def test_typing_stops_with_the_last_tab(self):
+        try:
+            first = await self.connect(self.alice)
+            second = await self.connect(self.alice)
+            bob = await self.connect(self.bob)
+            for communicator in (first, second, bob):
+                await self.subscribe(communicator, self.chat.id)
+            await self.frames(first)
+            await self.frames(second)
+
+            typing = {"type": "typing", "chat_id": self.chat.id}
+            await first.send_json_to(typing)
+            await second.send_json_to(typing)
+            self.assertEqual(len(events(await self.frames(bob), "typing")), 1)
+
+            await first.send_json_to({**typing, "is_typing": False})
+            self.assertEqual(events(await self.frames(bob), "typing_stopped"), [])
+
+            await second.send_json_to({**typing, "is_typing": False})
+            stopped = events(await self.frames(bob), "typing_stopped")
+            self.assertEqual([event["user_id"] for event in stopped], [self.alice.id])
+        finally:
+            await self.disconnect()
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    async def test_receipt_for_unstored_message_is_refused(self):
+        cache.clear()
+        try:
+            bob = await self.connect(self.bob)
+            await self.subscribe(bob, self.chat.id)
+            pending = await database_sync_to_async(prepare_message)(
+                self.chat.id, self.alice, "hi"
+            )
+
+            await bob.send_json_to({"type": "read_messages", "chat_id": self.chat.id})
+            errors = [
+                frame for frame in await self.frames(bob) if frame["type"] == "error"
+            ]
+            self.assertEqual([error["chat_id"] for error in errors], [self.chat.id])
+
+            await database_sync_to_async(persist_messages)([pending])
+            await bob.send_json_to({"type": "read_messages", "chat_id": self.chat.id})
+            errors = [
+                frame for frame in await self.frames(bob) if frame["type"] == "error"
+            ]
+            self.assertEqual(errors, [])
+        finally:
+            await self.disconnect()
+
+    @override_settings(WS_REPLAY_PAGE_SIZE=2, WS_REPLAY_LIMIT=3)
+    async def test_replay_is_truncated_at_the_limit(self):
+        for text in "abcd":
+            await database_sync_to_async(create_message)(self.chat.id, self.alice, text)
+        try:
+            bob = await self.connect(self.bob)
+            await self.frames(bob)
+            await bob.send_json_to(
+                {"type": "subscribe", "chat_id": self.chat.id, "last_seq": 0}
+            )
+            frames = await self.frames(bob)
+
+            pages = [
+                [message["seq"] for message in frame["messages"]]
+                for frame in frames
+                if frame["type"] == "replay"
+            ]
+            self.assertEqual(pages, [[1, 2], [3]])
+            (complete,) = [
+                frame for frame in frames if frame["type"] == "replay_complete"
+            ]
+            self.assertEqual((complete["last_seq"], complete["truncated"]), (3, True))
+        finally:
+            await self.disconnect()
+
+    @override_settings(WS_REPLAY_PAGE_SIZE=2, WS_REPLAY_LIMIT=4)
+    async def test_replay_of_exactly_the_limit_is_complete(self):
+        for text in "abcd":
+            await database_sync_to_async(create_message)(self.chat.id, self.alice, text)
+        try:
+            bob = await self.connect(self.bob)
+            await self.frames(bob)
+            await bob.send_json_to(
+                {"type": "subscribe", "chat_id": self.chat.id, "last_seq": 0}
+            )
+
+            frames = await self.frames(bob)
+            (complete,) = [
+                frame for frame in frames if frame["type"] == "replay_complete"
+            ]
+            self.assertEqual((complete["last_seq"], complete["truncated"]), (4, False))
+        finally:
+            await self.disconnect()
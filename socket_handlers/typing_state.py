@@ -0,0 +1,127 @@
+import asyncio
+from django.conf import settings
+
+
+class TypingRegistry:
+    """
+    Debounced typing indicator state per chat and user.
+
+    Every connection of a user (tabs, chat and multiplexed sockets) is a
+    source. Typing frames only refresh the source's in-memory deadline. A
+    ``typing`` broadcast is due when the user starts typing in a chat and
+    then at most once per refresh interval, whichever source the frames come
+    from. A stop is due only once the user's last typing source sends a
+    message, stops explicitly, disconnects or stays quiet for the TTL.
+    Nothing here touches the database.
+
+    The registry is shared by the connections of one process; sources on
+    other processes keep their own state.
+    """
+
+    def __init__(self, ttl=None, refresh=None):
+        self.ttl = ttl if ttl is not None else settings.TYPING_TTL
+        self.refresh = refresh if refresh is not None else settings.TYPING_REFRESH
+        # (chat_id, user_id) -> {source: expiry timer}
+        self._sources = {}
+        # (chat_id, user_id) -> loop time of the last typing broadcast
+        self._last_broadcast = {}
+        self._tasks = set()
+
+    def start(self, chat_id, user_id, source):
+        """Record a typing frame and return whether to broadcast it"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        key = (int(chat_id), user_id)
+
+        sources = self._sources.setdefault(key, {})
+        timer = sources.pop(source, None)
+        if timer is not None:
+            timer.cancel()
+        sources[source] = loop.call_later(self.ttl, self._expire, key, source)
+
+        last = self._last_broadcast.get(key)
+        if last is None or now - last >= self.refresh:
+            self._last_broadcast[key] = now
+            return True
+        return False
+
+    def stop(self, chat_id, user_id, source):
+        """Drop a source and return whether the user's stop is due"""
+        key = (int(chat_id), user_id)
+        sources = self._sources.get(key)
+        if sources is None:
+            return False
+        timer = sources.pop(source, None)
+        if timer is None:
+            return False
+        timer.cancel()
+        if sources:
+            # Still typing from another tab or socket
+            return False
+
+        del self._sources[key]
+        return self._last_broadcast.pop(key, None) is not None
+
+    def _expire(self, key, source):
+        sources = self._sources.get(key)
+        if sources is None:
+            return
+        sources.pop(source, None)
+        source.chats.discard(key[0])
+        if sources:
+            return
+
+        del self._sources[key]
+        if self._last_broadcast.pop(key, None) is not None:
+            task = asyncio.ensure_future(source.on_stop(key[0]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+class TypingState:
+    """
+    Typing indicator source of one connection.
+
+    Feeds the process wide ``TypingRegistry`` under the connection's user,
+    so that several sockets of the same user yield a single typing indicator
+    per chat. ``on_stop(chat_id)`` is awaited when a stop falls due on a
+    timer expiring for this connection.
+    """
+
+    def __init__(self, user_id, on_stop, registry=None):
+        self.user_id = user_id
+        self.on_stop = on_stop
+        self.typing_registry = registry or get_typing_registry()
+        # Chats this connection is typing in
+        self.chats = set()
+
+    def start(self, chat_id):
+        """Record a typing frame and return whether to broadcast it"""
+        self.chats.add(int(chat_id))
+        return self.typing_registry.start(chat_id, self.user_id, self)
+
+    def stop(self, chat_id):
+        """Clear this connection's typing and return whether a stop is due"""
+        self.chats.discard(int(chat_id))
+        return self.typing_registry.stop(chat_id, self.user_id, self)
+
+    def clear(self):
+        """Drop every typing state and return the chats that need a stop"""
+        chats = list(self.chats)
+        self.chats.clear()
+        return [
+            chat_id
+            for chat_id in chats
+            if self.typing_registry.stop(chat_id, self.user_id, self)
+        ]
+
+
+_registry = None
+
+
+def get_typing_registry():
+    """Return the process wide typing registry, creating it on first use"""
+    global _registry
+    if _registry is None:
+        _registry = TypingRegistry()
+    return _registry
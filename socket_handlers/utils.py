@@ -22,6 +22,11 @@ def get_user_ws_url(server_url, token):
     return get_websocket_url(server_url, "user", token)
 
 
+def get_stream_ws_url(server_url, token):
+    """Get the multiplexed WebSocket URL shared by all of a user's chats"""
+    return get_websocket_url(server_url, "stream", token)
+
+
 # Example usage (for documentation)
 """
 # In React Native:
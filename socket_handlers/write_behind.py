@@ -0,0 +1,84 @@
+import asyncio
+import weakref
+from django.conf import settings
+from chat.services import clear_pending, persist_messages
+from .db import db_sync_to_async
+
+
+class MessageWriter:
+    """
+    Batches prepared messages into bulk inserts.
+
+    Pending messages are written every ``interval`` seconds, or as soon as
+    ``batch_size`` of them are waiting. ``submit`` returns a future that
+    resolves once the message is committed, or raises the error that kept
+    it from being stored. A failed batch is retried message by message so
+    one bad row does not fail the others.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.batch_full = asyncio.Event()
+        self.flush_task = None
+
+    def submit(self, message):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.batch_size:
+            self.batch_full.set()
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_pending())
+        return future
+
+    async def flush_pending(self):
+        try:
+            while self.pending:
+                if len(self.pending) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self.batch_full.wait(), self.interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self.batch_full.clear()
+
+                batch = self.pending[: self.batch_size]
+                del self.pending[: self.batch_size]
+                await self.write(batch)
+        finally:
+            self.flush_task = None
+
+    async def write(self, batch):
+        try:
+            await db_sync_to_async(persist_messages)([message for message, _ in batch])
+        except Exception as e:
+            print(f"Write-behind batch error: {e}")
+            for message, future in batch:
+                try:
+                    await db_sync_to_async(persist_messages)([message])
+                except Exception as e:
+                    # Its seq stays unused, so replays may move past it
+                    clear_pending([message])
+                    future.set_exception(e)
+                else:
+                    future.set_result(message)
+            return
+
+        for message, future in batch:
+            future.set_result(message)
+
+
+# One writer per event loop, as its futures and tasks are bound to the loop
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = MessageWriter(
+            interval=settings.WRITE_BEHIND_INTERVAL_MS / 1000,
+            batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+        )
+        _writers[loop] = writer
+    return writer